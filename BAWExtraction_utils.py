@@ -6,6 +6,13 @@ requests.packages.urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWar
 from requests.auth import HTTPBasicAuth
 import csv
 import logging
+import logging.handlers
+import queue
+import reprlib
+import atexit
+import threading
+import signal
+import tracemalloc
 from tqdm import tqdm
 import time
 import sys
@@ -13,10 +20,25 @@ import aiohttp
 import asyncio
 from time import sleep
 from jsonpath_ng import jsonpath, parse
+import yaml
 from yaml.loader import SafeLoader
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import zipfile
+import gzip
+import io
 import os 
+import re
+import sqlite3
+import hashlib
+import random
+import collections
+from contextlib import asynccontextmanager
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 
@@ -89,16 +111,457 @@ TASK_SUMMARY_URL = "rest/bpm/wle/v1/process/"
 TASK_SUMMARY_URL_SUFFIX = "/taskSummary/"
 TASK_DETAIL_URL = "rest/bpm/wle/v1/task/"
 TASK_DETAIL_URL_SUFFIX = "?parts=data"
+TASK_DETAIL_URL_SUFFIX_NO_DATA = "?parts=none"
+TASK_BULK_URL = "rest/bpm/wle/v1/tasks?taskIDs="
+TASK_BULK_URL_SUFFIX = "&parts=data"
+TASK_BULK_URL_SUFFIX_NO_DATA = "&parts=none"
+LOGIN_URL = "bpm/system/login"
+
+
+# Circuit breaker of the BAW requests: after threshold consecutive failed requests the circuit opens and
+# no request is sent for reset_timeout seconds, then one request probes the server (half-open):
+# a success closes the circuit, a failure opens it again
+class CircuitBreaker:
+
+    def __init__(self, threshold, reset_timeout, logger):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logger
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.trips = 0
+
+    def allow_request(self):
+        if self.threshold <= 0 or self.opened is None:
+            return True
+        if time.monotonic() - self.opened < self.reset_timeout or self.probing:
+            return False
+        self.probing = True
+        return True
+
+    # seconds before the circuit half-opens
+    def remaining(self):
+        if self.opened is None:
+            return 0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened))
+
+    def record_success(self):
+        if self.opened is not None:
+            self.logger.info("Circuit breaker closed, BAW answers again")
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+
+    # the probe ended without an answer to record (cancelled, unreadable body), the next request probes again
+    def release_probe(self):
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened is None and self.threshold > 0 and self.failures >= self.threshold):
+            if not self.probing:
+                self.trips += 1
+            self.opened = time.monotonic()
+            self.probing = False
+            self.logger.warning(f"Circuit breaker open after {self.failures} consecutive failed requests, "
+                                f"no request to BAW for {self.reset_timeout} s")
+
+# auth_mode "session": one POST bpm/system/login with the Basic credentials, then the requests only carry
+# the LtpaToken2 cookie of the login session and its BPMCSRFToken header, so BAW does not check the
+# credentials against the user registry at each request. The first request that gets a 401 logs in again
+class SessionLogin:
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.lock = asyncio.Lock()
+        self.csrf_token = None
+        self.generation = 0
+        self.logins = 0
+
+    async def ensure(self, session):
+        if self.csrf_token is None:
+            await self.refresh(session, self.generation)
+        return self.generation
+
+    async def refresh(self, session, generation):
+        async with self.lock:
+            if generation != self.generation:
+                # another request logged in again meanwhile
+                return
+            auth = get_aiohttp_BAW_auth(self.config, self.logger)
+            if auth == 0:
+                self.logger.error('ERROR getting Auth')
+                return
+            url = self.config['root_url'] + LOGIN_URL
+            body = {"refresh_groups": False, "requested_lifetime": self.config.get('login_lifetime', 7200)}
+            async with session.post(url, auth=auth, json=body, ssl=False) as response:
+                if response.status != 200:
+                    self.logger.error(baw_error_message(response.status, await response.text()))
+                    self.csrf_token = None
+                    return
+                self.csrf_token = (await response.json())['csrf_token']
+            self.generation += 1
+            self.logins += 1
+            self.logger.info(f"Logged in to BAW as {self.config['user']}, login {self.logins}")
+
+    def headers(self):
+        return {"BPMCSRFToken": self.csrf_token} if self.csrf_token is not None else None
+
+class ScheduledRequest:
+
+    def __init__(self):
+        # set by the caller from the HTTP response
+        self.status = None
+        self.failed = False
+
+# Request slots shared by the schedulers of the jobs of a batch (config['thread_count'] of the batch):
+# when all the slots are taken, a freed slot goes to the next job, round-robin, among the jobs that
+# have requests waiting, so a job with thousands of queued tasks does not starve the smaller jobs
+# and the slots of an idle job are used by the others
+class SharedRequestPool:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiters = {}
+        self.order = collections.deque()
+
+    async def acquire(self, job):
+        # while slots are free nothing waits
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        queue = self.waiters.setdefault(job, collections.deque())
+        if len(queue) == 0:
+            self.order.append(job)
+        queue.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # the slot was handed over just before the cancellation, hand it over again
+            if not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while len(self.order) > 0:
+            job = self.order.popleft()
+            queue = self.waiters[job]
+            future = queue.popleft()
+            if len(queue) > 0:
+                self.order.append(job)
+            if not future.done():
+                # the slot goes to the waiting request, in_flight is unchanged
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+# Global scheduler of the BAW requests of a run: one semaphore bounds the number of
+# concurrent task summary and task detail requests across all the instances and tasks,
+# and it keeps track of how much of the connection pool is in use.
+#
+# In adaptive mode the limit moves between 1 and the configured limit (AIMD): every window of
+# completed requests, the limit grows by one while the p95 latency stays close to the lowest p95 seen,
+# it is cut by 10% when the p95 latency rises, and halved when a request of the window failed
+# (5xx, 429, timeout or connection error), so a struggling BAW server is not pushed further.
+class RequestScheduler:
+
+    def __init__(self, limit, logger=None, adaptive=False, initial_limit=2, window=20, latency_tolerance=1.5,
+                 breaker_threshold=0, breaker_reset_timeout=30):
+        self.limit = limit
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset_timeout, self.logger)
+        # set by create_request_scheduler in auth_mode "session"
+        self.session_login = None
+        # SharedRequestPool of the batch, the limit of the scheduler is then the limit of its job
+        self.pool = None
+        self.pool_waiting = 0
+        self.retries = 0
+        # task detail requests avoided by the summaries and the bulk requests
+        self.tasks_from_summary = 0
+        self.bulk_requests = 0
+        self.bulk_tasks = 0
+        self.adaptive = adaptive
+        self.semaphore = asyncio.Semaphore(limit)
+        self.condition = asyncio.Condition()
+        self.current_limit = float(min(initial_limit, limit)) if adaptive else float(limit)
+        self.window = window
+        self.latency_tolerance = latency_tolerance
+        self.window_latencies = []
+        self.window_failures = 0
+        self.baseline_p95 = None
+        self.decisions = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.wait_time = 0.0
+        self.busy_time = 0.0 # sum over time of the number of requests in flight
+        self.started = time.monotonic()
+        self.last_change = self.started
+
+    def _update_busy_time(self):
+        now = time.monotonic()
+        self.busy_time += self.in_flight * (now - self.last_change)
+        self.last_change = now
+
+    async def _acquire(self):
+        if not self.adaptive:
+            await self.semaphore.acquire()
+        else:
+            async with self.condition:
+                # the requests waiting for a slot of the pool count in the limit of the job
+                await self.condition.wait_for(lambda: self.in_flight + self.pool_waiting < int(self.current_limit))
+        if self.pool is not None:
+            self.pool_waiting += 1
+            try:
+                await self.pool.acquire(self)
+            except BaseException:
+                if not self.adaptive:
+                    self.semaphore.release()
+                raise
+            finally:
+                self.pool_waiting -= 1
+
+    async def _release(self):
+        if self.pool is not None:
+            self.pool.release()
+        if not self.adaptive:
+            self.semaphore.release()
+            return
+        async with self.condition:
+            # the limit may have grown, wake up all the waiting requests
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        request = ScheduledRequest()
+        queued = time.monotonic()
+        await self._acquire()
+        self.wait_time += time.monotonic() - queued
+        self._update_busy_time()
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        started = time.monotonic()
+        try:
+            yield request
+        except Exception:
+            request.failed = True
+            raise
+        finally:
+            self._update_busy_time()
+            self.in_flight -= 1
+            if self.adaptive:
+                self._record(request, time.monotonic() - started)
+            await self._release()
+
+    def _record(self, request, latency):
+        if request.failed or request.status == 429 or (request.status is not None and request.status >= 500):
+            self.window_failures += 1
+        self.window_latencies.append(latency)
+        if len(self.window_latencies) >= self.window:
+            self._adjust_limit()
+
+    def _adjust_limit(self):
+        latencies = sorted(self.window_latencies)
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+        failures = self.window_failures
+        self.window_latencies = []
+        self.window_failures = 0
+        old_limit = self.current_limit
+        if failures > 0:
+            self.current_limit = max(1.0, self.current_limit / 2)
+            decision = f"{failures} failed requests"
+        elif self.baseline_p95 is not None and p95 > self.baseline_p95 * self.latency_tolerance:
+            self.current_limit = max(1.0, self.current_limit * 0.9)
+            decision = "latency rising"
+        else:
+            self.current_limit = min(float(self.limit), self.current_limit + 1)
+            decision = "latency flat"
+        # the baseline follows the lowest p95, and slowly drifts up when the server gets slower for good
+        if self.baseline_p95 is None or p95 < self.baseline_p95:
+            self.baseline_p95 = p95
+        else:
+            self.baseline_p95 = self.baseline_p95 * 1.02
+        if int(old_limit) != int(self.current_limit):
+            self.decisions += 1
+            self.logger.info(f"Adaptive concurrency: {int(old_limit)} -> {int(self.current_limit)} ({decision}), "
+                             f"p95 {p95*1000:.1f} ms, baseline p95 {self.baseline_p95*1000:.1f} ms")
+
+    def pool_usage(self):
+        self._update_busy_time()
+        elapsed = self.last_change - self.started
+        average_in_flight = self.busy_time / elapsed if elapsed > 0 else 0
+        return {
+            "limit": self.limit,
+            "current_limit": int(self.current_limit),
+            "requests": self.requests,
+            "peak_in_flight": self.peak_in_flight,
+            "average_in_flight": average_in_flight,
+            "utilization": average_in_flight / self.limit,
+            "average_wait": self.wait_time / self.requests if self.requests > 0 else 0
+        }
+
+    def report(self, logger):
+        usage = self.pool_usage()
+        message = (f"Connection pool usage: {usage['requests']} requests, peak {usage['peak_in_flight']}/{usage['limit']} in flight, "
+                   f"average {usage['average_in_flight']:.1f} ({usage['utilization']:.0%}), "
+                   f"average wait for a connection {usage['average_wait']*1000:.1f} ms")
+        if self.adaptive:
+            message += f", adaptive limit {usage['current_limit']} after {self.decisions} changes"
+        if self.retries > 0 or self.breaker.trips > 0:
+            message += f", {self.retries} retries, circuit breaker opened {self.breaker.trips} times"
+        if self.session_login is not None:
+            message += f", {self.session_login.logins} logins"
+        print(message)
+        logger.info(message)
+        if self.tasks_from_summary > 0 or self.bulk_requests > 0:
+            saved = self.tasks_from_summary + self.bulk_tasks - self.bulk_requests
+            message = (f"Task details: {self.tasks_from_summary} events from the task summaries, {self.bulk_tasks} tasks in "
+                       f"{self.bulk_requests} bulk requests, {saved} task detail requests saved")
+            print(message)
+            logger.info(message)
+        return usage
+
+# config['thread_count'] is the limit, the ceiling of the adaptive limit when config['adaptive_concurrency'] is set
+def create_request_scheduler(config, logger):
+    scheduler = RequestScheduler(config['thread_count'], logger,
+                            adaptive=config.get('adaptive_concurrency', False),
+                            initial_limit=config.get('adaptive_initial_limit', 2),
+                            window=config.get('adaptive_window', 20),
+                            latency_tolerance=config.get('adaptive_latency_tolerance', 1.5),
+                            breaker_threshold=config.get('circuit_breaker_threshold', 10),
+                            breaker_reset_timeout=config.get('circuit_breaker_reset_timeout', 30))
+    if config.get('auth_mode', "basic") == "session":
+        scheduler.session_login = SessionLogin(config, logger)
+    return scheduler
+
+# The response bodies are decoded from the raw bytes with orjson when it is installed, the json module otherwise
+def decode_json(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def is_retryable_status(status):
+    return status is None or status == 429 or status >= 500
+
+# Full jitter: a random delay up to the exponential backoff of the attempt, so the retries
+# of the concurrent requests do not hit BAW at the same time. Retry-After is honored when there is one.
+def retry_delay(attempt, config, retry_after=None):
+    delay = random.uniform(0, min(config.get('retry_max_backoff', 30), config.get('retry_backoff', 0.5) * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+# GET a BAW REST url through the scheduler and return (status, payload): the json payload on a 200,
+# the error text otherwise, status is None when no response was received.
+# Timeouts, connection errors, 429 and 5xx responses are retried config['retry_count'] times.
+# The credentials are those of the session, or of the login session in auth_mode "session".
+# Each attempt is recorded in config['metrics'] under endpoint
+async def get_baw_json(session, scheduler, url, config, logger, endpoint):
+    status, payload = None, "no request sent"
+    retry_after = None
+    session_login = scheduler.session_login
+    metrics = config.get('metrics')
+    profile = config.get('profile_data')
+    retry_count = config.get('retry_count', 3)
+    attempt = 0
+    logins = 0
+    while attempt <= retry_count:
+        if attempt > 0 and status != 401:
+            scheduler.retries += 1
+            delay = retry_delay(attempt, config, retry_after)
+            logger.debug("Retry %d of %s in %.2f s after %s", attempt, url, delay, status if status is not None else payload)
+            await asyncio.sleep(delay)
+        if not scheduler.breaker.allow_request():
+            status, payload = None, "circuit breaker open"
+            retry_after = scheduler.breaker.remaining()
+            attempt += 1
+            continue
+        retry_after = None
+        headers = None
+        started = time.monotonic()
+        body_size = 0
+        queued = sent = time.perf_counter()
+        try:
+            if session_login is not None:
+                login_generation = await session_login.ensure(session)
+                headers = session_login.headers()
+            async with scheduler.slot() as request:
+                sent = time.perf_counter()
+                async with session.get(url, headers=headers, ssl=False) as response:
+                    status = response.status
+                    request.status = status
+                    body = await response.read()
+                    received = time.perf_counter()
+                    body_size = len(body)
+                    if status == 200:
+                        payload = decode_json(body)
+                        if profile is not None:
+                            profile.add("json_decode", time.perf_counter() - received)
+                    else:
+                        payload = body.decode('utf-8', errors='replace')
+                        if response.headers.get('Retry-After', "").isdigit():
+                            retry_after = int(response.headers['Retry-After'])
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, payload = None, f"{type(e).__name__}: {e}"
+            received = time.perf_counter()
+        except BaseException:
+            # a half-open circuit must not wait forever for the verdict of this request
+            scheduler.breaker.release_probe()
+            raise
+        if profile is not None:
+            profile.add("scheduler_wait", sent - queued)
+            profile.add("network_wait", received - sent)
+        if metrics is not None:
+            metrics.observe_request(endpoint, started, time.monotonic(), status, body_size)
+        if status == 401 and session_login is not None and logins < retry_count:
+            # the login session expired, log in again and send the request again right away;
+            # BAW answered, so the request counts as a success for the circuit breaker
+            scheduler.breaker.record_success()
+            logins += 1
+            await session_login.refresh(session, login_generation)
+            continue
+        if not is_retryable_status(status):
+            scheduler.breaker.record_success()
+            return status, payload
+        scheduler.breaker.record_failure()
+        attempt += 1
+    return status, payload
+
+def baw_error_message(status, payload):
+    if status is None:
+        return f"BAW REST API request failed: {payload}"
+    try:
+        reason = json.loads(payload)['Data']['errorMessage']
+    except (ValueError, KeyError, TypeError):
+        reason = payload[:200]
+    return f"BAW REST API response code: {status}, {reason}"
 
-
-def build_instance_search_url(config):
+# offset and limit override config['offset'] and config['instance_limit'] for the paginated search
+def build_instance_search_url(config, offset=None, limit=None):
     url = config['root_url'] + PROCESS_SEARCH_URL
 
     # from_date and from_date_criteria
-    from_date_str = config['from_date_criteria']+"="+config['from_date']
+    # in incremental mode, only the instances modified after the high-water mark of the previous run
+    if config.get('high_water_mark'):
+        from_date_str = "modifiedAfter="+config['high_water_mark']
+    elif config.get('window_start'):
+        from_date_str = config['from_date_criteria']+"="+config['window_start']
+    else:
+        from_date_str = config['from_date_criteria']+"="+config['from_date']
 
     # to_date and to_date_criteria
     to_date_str = config['to_date_criteria']+"="+config['to_date']
+    # the sub-window of a shard is on the attribute of from_date_criteria,
+    # the configured to_date bound is kept when it is on the other attribute
+    if config.get('window_end'):
+        window_criteria = config['from_date_criteria'].replace("After", "Before")
+        window_str = window_criteria+"="+config['window_end']
+        to_date_str = window_str if window_criteria == config['to_date_criteria'] else to_date_str+"&"+window_str
 
     url = url + from_date_str + "&" + to_date_str
 
@@ -106,31 +569,127 @@ def build_instance_search_url(config):
     url = url + "&" + config['process_name'] + PROCESS_SEARCH_PROJECT_FILTER + config['project']
 
   
-    if config['instance_limit'] > 0 :
-        url = url + f"&limit={str(config['instance_limit'])}"
+    if limit is None:
+        limit = config['instance_limit']
+    if offset is None:
+        offset = config['offset']
 
-    if config['offset'] > 0 :
-        url = url + f"&offset={str(config['offset'])}"
+    if limit > 0 :
+        url = url + f"&limit={str(limit)}"
+
+    if offset > 0 :
+        url = url + f"&offset={str(offset)}"
 
     if config['status_filter'] != "":
         url = url + "&statusFilter="+config['status_filter']
 
     return url
 
+# Incremental extraction: the largest lastModificationTime seen per project/BPD is saved in config['state_file']
+# and the next run searches the instances modified after it, instead of the whole from_date..to_date window
+def high_water_mark_key(config):
+    return config['project'] + "/" + config['process_name']
+
+def load_extraction_state(config):
+    try:
+        with open(config['state_file']) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+def load_high_water_mark(config):
+    return load_extraction_state(config).get(high_water_mark_key(config), {}).get('lastModificationTime')
+
+def save_high_water_mark(config, high_water_mark, logger):
+    state = load_extraction_state(config)
+    state[high_water_mark_key(config)] = {
+        "lastModificationTime": high_water_mark,
+        "saved": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+    }
+    # write a temporary file and rename it, a crash never leaves a truncated state file
+    temp_filename = config['state_file'] + ".tmp"
+    with open(temp_filename, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temp_filename, config['state_file'])
+    logger.info(f"High-water mark of {high_water_mark_key(config)} saved: {high_water_mark}")
+
+# Fetch one page of the instance search, returns the processes of the page and the overview.Total of the search
+async def get_instance_page(session, scheduler, offset, limit, config, logger):
+    url = build_instance_search_url(config, offset, limit)
+    logger.info(url)
+    status, instance_data_json = await get_baw_json(session, scheduler, url, config, logger, "search")
+    if status == 200:
+        return instance_data_json['data']['processes'], instance_data_json['data'].get('overview', {}).get('Total')
+    else:
+        message = baw_error_message(status, instance_data_json)
+        logger.error(message)
+        print(message)
+        return [], None
+
+# Paginated search: the first page gives the overview.Total of the search, the other pages are then fetched concurrently.
+# The instances are added to instance_list, and to instance_queue when there is one, as each page arrives
+async def search_instances(session, scheduler, instance_list, config, logger, instance_queue=None, pbar=None):
+    page_size = config['search_page_size']
+    offset = config['offset']
+    if config['instance_limit'] > 0:
+        page_size = min(page_size, config['instance_limit'])
+
+    def add_instances(processes):
+        for bpd_instance in processes:
+            instance = {'piid' : bpd_instance['piid'], 'lastModificationTime' : bpd_instance.get('lastModificationTime')}
+            instance_list.append(instance)
+            if instance_queue is not None:
+                instance_queue.put_nowait(instance)
+        if pbar is not None:
+            pbar.total += len(processes)
+            pbar.refresh()
+
+    processes, total = await get_instance_page(session, scheduler, offset, page_size, config, logger)
+    add_instances(processes)
+    if total is None:
+        logger.info("No overview.Total in the search response, only the first page is fetched")
+        return instance_list
+
+    end = total if config['instance_limit'] <= 0 else min(total, offset + config['instance_limit'])
+    # the server can cap the page size below the requested one
+    if 0 < len(processes) < page_size and offset + len(processes) < end:
+        page_size = len(processes)
+    page_offsets = range(offset + len(processes), end, page_size) if len(processes) > 0 else []
+    logger.info(f"Search of {total} instances: {len(page_offsets) + 1} pages of {page_size} instances")
+
+    pages = [asyncio.ensure_future(get_instance_page(session, scheduler, page_offset, min(page_size, end - page_offset), config, logger))
+             for page_offset in page_offsets]
+    try:
+        for page in asyncio.as_completed(pages):
+            processes, total = await page
+            add_instances(processes)
+    finally:
+        for page in pages:
+            page.cancel()
+        await asyncio.gather(*pages, return_exceptions=True)
+    return instance_list
+
 def get_instance_list(instance_list, config, logger):
     try:
         url = build_instance_search_url(config)
         message = f"Search URL : {url}"
         logger.info(url)
+        started = time.monotonic()
+        sent = time.perf_counter()
         response = requests.get(url, auth=config['auth_data'], verify=False)
+        profile_time(config, "network_wait", sent)
         status = response.status_code
+        if config.get('metrics') is not None:
+            config['metrics'].observe_request("search", started, time.monotonic(), status, len(response.content))
 
         if status == 200:
+            decode_started = time.perf_counter()
             instance_data_json = response.json()
-            logger.debug("Retrieved instance list: %s" % instance_data_json)
+            profile_time(config, "json_decode", decode_started)
+            debug_dump(logger, "Retrieved instance list:", instance_data_json, config)
 
             for bpd_instance in instance_data_json['data']['processes']:
-                instance_list.append({'piid' : bpd_instance['piid']})
+                instance_list.append({'piid' : bpd_instance['piid'], 'lastModificationTime' : bpd_instance.get('lastModificationTime')})
         else :
             error = json.loads(response.text)
             message = f"BAW REST API response code: {response.status_code}, reason: {response.reason}, {error['Data']['errorMessage']}"
@@ -143,72 +702,114 @@ def get_instance_list(instance_list, config, logger):
     
     return instance_list
 
-# Function to fetch task details info for a specific instance
-async def create_events(session, instance, event_data, pbar, config, logger):
+# Function to fetch the task details of one task and create its event
+async def create_event(session, scheduler, task_id, event_data, pbar, config, logger):
 
-    auth = get_aiohttp_BAW_auth(config, logger)
-    if auth == 0:
-        logger.error('ERROR getting Auth')
+    # closed tasks are served from the task cache
+    task_cache = config.get('task_cache')
+    if add_cached_event(task_id, event_data, pbar, config):
         return
+
+    dead_letters = config.get('dead_letters')
     try:
-        for task_id in instance['task_list']:
-            url = config['root_url'] + TASK_DETAIL_URL + task_id + TASK_DETAIL_URL_SUFFIX
-            logger.debug(f"Creating event for task : {task_id}")
-            async with session.get(url, auth=auth, ssl=False) as task_detail_response:
-                task_detail_status = task_detail_response.status
-                if task_detail_status == 200:
-                    task_detail_data = await task_detail_response.json()
-                    # print(task_detail_data)
-
-                    task_data=task_detail_data['data']
-                    task_data_keys = task_data.keys()
-
-                    # Create the process mining event 
-                    event={}
-
-                    # find and rename the keys that are mapped into process mining keys
-                    ipm_mapping = config['BAW_fields']['process_mining_mapping']
-                    ipm_fields = ipm_mapping.keys()
-                    for field in ipm_fields:
-                        if (ipm_mapping[field] in task_data_keys):
-                            event[field]=task_data.pop(ipm_mapping[field])
-                        else:
-                            logger.error("Error: task data: %s mapped to: %s not found" % (ipm_mapping[field], field))
-
-                    # include the keys that in config['BAW_fields']['included_task_data']
-                    keepkeys = config['BAW_fields']['included_task_data']
-                    for key in keepkeys:
-                        if (key in task_data_keys):
-                            event[key] = task_data.pop(key)      
-
-                    # Take care of the process data if any, that's an array!
-                    # only if ['BAW']['export_exposed_variables'] == True
-                    if (config['export_exposed_variables'] == True) and ("processData" in task_data_keys):
-                        processdata = task_data["processData"]
-                        businessdata = processdata['businessData']
-                        for trackeddata in businessdata:
-                            event["trkd."+trackeddata['name']]=trackeddata['value']
-                        
-                    # Append the data.variables that are listed
-                    data_variables = config['task_data_variables']
-                    # Search from 'data.variables' keep 'data.' before each variable name
-                    for searched_var in data_variables:
-                        # Default value to use if no match is found in the task data
-                        variable_value = ""
-                        jsonpath_expression = parse("variables"+"."+searched_var)
-                        for match in jsonpath_expression.find(task_data['data']):
-                            # Update the default variable
-                            variable_value = match.value
-                            break
-                        # Add the value to the event dictionary (could be "")
-                        event["tsk."+searched_var]=variable_value
-                    
-                    # append event to the event_data array
-                    event_data.append(event)
-                    pbar.update(1)
+        url = config['root_url'] + TASK_DETAIL_URL + task_id + get_task_projection(config).detail_url_suffix
+        logger.debug("Creating event for task : %s", task_id)
+        task_detail_status, task_detail_data = await get_baw_json(session, scheduler, url, config, logger, "task_detail")
+        if task_detail_status == 200:
+            # print(task_detail_data)
+
+            task_data=task_detail_data['data']
+            task_closed = is_closed_task(task_data)
+
+            # Create the process mining event with the projection compiled for this run
+            projection_started = time.perf_counter()
+            event = get_task_projection(config).project(task_data, logger)
+            profile_time(config, "projection", projection_started)
+
+            if task_cache is not None:
+                task_cache.put(task_id, event, task_closed)
+
+            # append event to the event_data array
+            event_data.append(event)
+            pbar.update(1)
+            if dead_letters is not None:
+                dead_letters.discard_task(task_id)
+        else:
+            message = f"Task {task_id}: {baw_error_message(task_detail_status, task_detail_data)}"
+            logger.error(message)
+            if dead_letters is not None:
+                dead_letters.add_task(task_id, message)
     except Exception as e:
         message = f"Unexpected error while creating event from : {task_id}"
         print(message)
+        logger.error(message)
+        logger.error(e)
+        if dead_letters is not None:
+            dead_letters.add_task(task_id, f"{message}: {e}")
+
+def add_cached_event(task_id, event_data, pbar, config):
+    if config.get('task_cache') is None:
+        return False
+    event = config['task_cache'].get(task_id)
+    if event is None:
+        return False
+    event_data.append(get_task_projection(config).restore(event))
+    pbar.update(1)
+    return True
+
+# Fetch the task details of several tasks in one request (config['task_detail_mode'] == "bulk")
+# and create their events. The tkiids missing from the response go to the dead-letter file
+async def create_events_bulk(session, scheduler, task_ids, event_data, pbar, config, logger):
+    task_cache = config.get('task_cache')
+    dead_letters = config.get('dead_letters')
+    task_ids = [task_id for task_id in task_ids if not add_cached_event(task_id, event_data, pbar, config)]
+    if len(task_ids) == 0:
+        return
+    if len(task_ids) == 1:
+        await create_event(session, scheduler, task_ids[0], event_data, pbar, config, logger)
+        return
+
+    try:
+        url = config['root_url'] + TASK_BULK_URL + ",".join(task_ids) + get_task_projection(config).bulk_url_suffix
+        logger.debug("Creating events for %d tasks : %s ..", len(task_ids), task_ids[0])
+        scheduler.bulk_requests += 1
+        status, task_bulk_data = await get_baw_json(session, scheduler, url, config, logger, "task_bulk")
+        if status == 200:
+            projection = get_task_projection(config)
+            missing_task_ids = set(task_ids)
+            for task_data in task_bulk_data['data']['tasks']:
+                task_id = str(task_data.get('tkiid'))
+                if task_id not in missing_task_ids:
+                    continue
+                missing_task_ids.discard(task_id)
+                projection_started = time.perf_counter()
+                event = projection.project(task_data, logger)
+                profile_time(config, "projection", projection_started)
+                if task_cache is not None:
+                    task_cache.put(task_id, event, is_closed_task(task_data))
+                event_data.append(event)
+                pbar.update(1)
+                scheduler.bulk_tasks += 1
+                if dead_letters is not None:
+                    dead_letters.discard_task(task_id)
+            for task_id in missing_task_ids:
+                logger.error(f"Task {task_id}: not in the bulk task details response")
+                if dead_letters is not None:
+                    dead_letters.add_task(task_id, "not in the bulk task details response")
+        else:
+            message = baw_error_message(status, task_bulk_data)
+            logger.error(f"Tasks {task_ids[0]} .. {task_ids[-1]}: {message}")
+            if dead_letters is not None:
+                for task_id in task_ids:
+                    dead_letters.add_task(task_id, f"Task {task_id}: {message}")
+    except Exception as e:
+        message = f"Unexpected error while creating the events of {len(task_ids)} tasks"
+        print(message)
+        logger.error(message)
+        logger.error(e)
+        if dead_letters is not None:
+            for task_id in task_ids:
+                dead_letters.add_task(task_id, f"{message}: {e}")
 
 # get BAW auth from environment variable or from config file
 def get_aiohttp_BAW_auth(config, logger):
@@ -234,107 +835,1132 @@ def get_aiohttp_BAW_auth(config, logger):
     return(aiohttp.BasicAuth(login=config['user'], password=pwd, encoding='utf-8'))
 
 # Function to fetch task summary info for a specific instance
-async def get_tasks(session, instance, pbar, config, logger):
+# With event_data, the tasks whose summary has all the fields of the projection get their event
+# from the summary, only the other tasks are put in the task_list for the task detail requests.
+# Returns the number of events created from the summaries
+async def get_tasks(session, scheduler, instance, pbar, config, logger, event_data=None):
 
-    logger.debug('Fetching tasks for bpd instance : ' + instance['piid'])
+    logger.debug("Fetching tasks for bpd instance : %s", instance['piid'])
     url = config['root_url'] + TASK_SUMMARY_URL + instance['piid'] + TASK_SUMMARY_URL_SUFFIX
     #print(f"Task summaries URL: {url}")
-    
-    auth = get_aiohttp_BAW_auth(config, logger)
-    if auth == 0:
-        logger.error('ERROR getting Auth')
+    # no task list until the task summaries are received
+    instance['task_list'] = []
+    dead_letters = config.get('dead_letters')
+
+    task_summary_status, task_summary_data = await get_baw_json(session, scheduler, url, config, logger, "task_summary")
+    summary_events = 0
+    if task_summary_status == 200:
+        task_list = []
+        projection = get_task_projection(config)
+        for task_summary in task_summary_data['data']['tasks']:
+            task_id = task_summary['tkiid']
+            logger.debug("Instance %s found Task : %s", instance['piid'], task_id)
+            if event_data is not None and projection.covered_by(task_summary):
+                projection_started = time.perf_counter()
+                event_data.append(projection.project(task_summary, logger))
+                profile_time(config, "projection", projection_started)
+                summary_events += 1
+                continue
+            task_list.append(task_id)
+
+        # We have the instance + a list of its task id's
+        # Update the bpd_instance_dict that was passed from the calling function
+        instance['task_list'] = task_list
+        pbar.update(1)
+        if dead_letters is not None:
+            dead_letters.discard_instance(instance['piid'])
+    else:
+        message = f"Instance {instance['piid']}: {baw_error_message(task_summary_status, task_summary_data)}"
+        logger.error(message)
+        if dead_letters is not None:
+            dead_letters.add_instance(instance['piid'], message)
+    scheduler.tasks_from_summary += summary_events
+    return summary_events
+
+
+# Stage 1 of the pipeline: fetch the task summaries of the instances and
+# push each tkiid to the task queue as soon as its instance task list arrives
+async def task_summary_worker(session, scheduler, instance_queue, task_queue, event_data, instance_pbar, task_pbar, config, logger):
+    while True:
+        instance = await instance_queue.get()
+        if instance is None: # no more instances
+            return
+        try:
+            summary_events = await get_tasks(session, scheduler, instance, instance_pbar, config, logger, event_data)
+            task_pbar.total += summary_events
+            task_pbar.update(summary_events)
+        except Exception as e:
+            message = f"Unexpected error while fetching the tasks of instance : {instance['piid']}"
+            logger.error(message)
+            logger.error(e)
+            if config.get('dead_letters') is not None:
+                config['dead_letters'].add_instance(instance['piid'], f"{message}: {e}")
+        task_list = instance.get('task_list', [])
+        task_pbar.total += len(task_list)
+        task_pbar.refresh()
+        for task_id in task_list:
+            # blocks when the detail workers are behind, the queue is bounded
+            await task_queue.put(task_id)
+
+# Stage 2 of the pipeline: fetch the task details and create the events.
+# In bulk mode, a worker takes the tkiids already queued, up to config['bulk_task_count'], for one request
+async def task_detail_worker(session, scheduler, task_queue, event_data, task_pbar, config, logger):
+    bulk_task_count = config.get('bulk_task_count', 50) if config.get('task_detail_mode', "single") == "bulk" else 1
+    while True:
+        task_id = await task_queue.get()
+        if task_id is None: # no more tasks
+            return
+        if bulk_task_count <= 1:
+            await create_event(session, scheduler, task_id, event_data, task_pbar, config, logger)
+            continue
+        task_ids = [task_id]
+        last_batch = False
+        while len(task_ids) < bulk_task_count and not task_queue.empty():
+            task_id = task_queue.get_nowait()
+            if task_id is None:
+                last_batch = True
+                break
+            task_ids.append(task_id)
+        await create_events_bulk(session, scheduler, task_ids, event_data, task_pbar, config, logger)
+        if last_batch:
+            return
+
+# Projection of the task details into process mining events, compiled once per run from
+# config['BAW_fields'] and config['task_data_variables'].
+# The events have the columns in a fixed order: the process mining fields, the included task data,
+# the tracked fields (trkd.*) when export_exposed_variables is set, then the task variables (tsk.*)
+SIMPLE_VARIABLE_PATH = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+# Task data with few distinct values, repeated across the events: one string object per value
+INTERNED_TASK_DATA = {"name", "status", "state", "owner", "teamDisplayName", "teamName", "managerTeamDisplayName",
+                      "priorityName", "assignedToType", "assignedToDisplayName", "closeByUser", "originator", "description"}
+
+# Compact event row: a tuple with one value per column of the projection, None when the task has no such data,
+# then a dict of the tracked fields that are not in config['exposed_variables'] (None when there are none).
+# The low cardinality strings and the variable values are interned, the events of a run share their string objects
+class TaskProjection:
+
+    def __init__(self, config):
+        ipm_mapping = config['BAW_fields']['process_mining_mapping']
+        self.mapped_fields = list(ipm_mapping.items())
+        # the task data mapped into a process mining field is not included a second time
+        self.included_keys = []
+        for key in config['BAW_fields']['included_task_data']:
+            if key not in ipm_mapping.values() and key not in self.included_keys:
+                self.included_keys.append(key)
+        self.export_exposed_variables = (config['export_exposed_variables'] == True)
+        # names of the tracked fields are only known from the payloads, the expected ones can be listed in config['exposed_variables']
+        self.tracked_columns = []
+        if self.export_exposed_variables:
+            self.tracked_columns = ["trkd."+name for name in config.get('exposed_variables', [])]
+        # data.variables paths: a plain dotted path is walked directly, any other expression is parsed once with jsonpath
+        self.variables = []
+        for searched_var in config['task_data_variables']:
+            if SIMPLE_VARIABLE_PATH.match(searched_var):
+                self.variables.append(("tsk."+searched_var, tuple(searched_var.split('.')), None))
+            else:
+                self.variables.append(("tsk."+searched_var, None, parse("variables"+"."+searched_var)))
+        self.columns = ([field for field, key in self.mapped_fields] + self.included_keys + self.tracked_columns +
+                        [column for column, path, expression in self.variables])
+        # without tracked fields nor variables, a task summary with all these keys gives the same event as the task details
+        self.needs_details = self.export_exposed_variables or len(self.variables) > 0
+        self.task_keys = [key for field, key in self.mapped_fields] + self.included_keys
+        # the data.variables business objects are only transferred and decoded when a variable or a tracked field is needed
+        self.detail_url_suffix = TASK_DETAIL_URL_SUFFIX if self.needs_details else TASK_DETAIL_URL_SUFFIX_NO_DATA
+        self.bulk_url_suffix = TASK_BULK_URL_SUFFIX if self.needs_details else TASK_BULK_URL_SUFFIX_NO_DATA
+        self.task_key_interned = [key in INTERNED_TASK_DATA for key in self.task_keys]
+        self.mapped_count = len(self.mapped_fields)
+        self.tracked_index = {column[len("trkd."):]: index for index, column in enumerate(self.tracked_columns)}
+        self.interned = {}
+        self.max_interned = config.get('max_interned_values', 100000)
+
+    # True when the event can be created from this task payload without the task details
+    def covered_by(self, task_summary):
+        return not self.needs_details and all(key in task_summary for key in self.task_keys)
+
+    def intern(self, value):
+        if type(value) is not str:
+            return value
+        interned = self.interned.get(value)
+        if interned is not None:
+            return interned
+        # high cardinality values stop filling the table
+        if len(self.interned) < self.max_interned:
+            self.interned[value] = value
+        return value
+
+    def project(self, task_data, logger):
+        row = []
+        for index, key in enumerate(self.task_keys):
+            if key in task_data:
+                value = task_data[key]
+                row.append(self.intern(value) if self.task_key_interned[index] else value)
+            else:
+                if index < self.mapped_count:
+                    logger.error("Error: task data: %s mapped to: %s not found" % (key, self.mapped_fields[index][0]))
+                row.append(None)
+
+        # Take care of the process data if any, that's an array!
+        extra_fields = None
+        if self.export_exposed_variables:
+            tracked = [None] * len(self.tracked_columns)
+            if "processData" in task_data:
+                for trackeddata in task_data["processData"]['businessData']:
+                    index = self.tracked_index.get(trackeddata['name'])
+                    if index is not None:
+                        tracked[index] = trackeddata['value']
+                    else:
+                        if extra_fields is None:
+                            extra_fields = {}
+                        extra_fields["trkd."+trackeddata['name']] = trackeddata['value']
+            row.extend(tracked)
+
+        # Search the variables in 'data.variables', "" when not found
+        variables = (task_data.get('data') or {}).get('variables')
+        for column, path, expression in self.variables:
+            variable_value = ""
+            if path is not None:
+                value = variables
+                for key in path:
+                    if not isinstance(value, dict) or key not in value:
+                        break
+                    value = value[key]
+                else:
+                    variable_value = value
+            else:
+                for match in expression.find(task_data.get('data') or {}):
+                    variable_value = match.value
+                    break
+            row.append(self.intern(variable_value))
+        row.append(extra_fields)
+        return tuple(row)
+
+    # Row read back from the task cache (a JSON list)
+    def restore(self, values):
+        return tuple(self.intern(value) for value in values)
+
+    # The event as a dict, the columns without a value are left out
+    def event_dict(self, row):
+        event = {column: value for column, value in zip(self.columns, row) if value is not None}
+        if row[-1] is not None:
+            event.update(row[-1])
+        return event
+
+def get_task_projection(config):
+    if config.get('task_projection') is None:
+        config['task_projection'] = TaskProjection(config)
+    return config['task_projection']
+
+# On-disk cache of the events created from the task details, keyed by tkiid.
+# Closed tasks never change: their cached event is used without any HTTP call.
+# Open tasks are fetched again at each run and their cached event is replaced.
+# Entries created with another mapping or variable list are ignored, the least recently used entries
+# are evicted when there are more than max_entries.
+class TaskCache:
+
+    def __init__(self, filename, max_entries, config):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.schema = task_cache_schema(config)
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        # the writes of a page are buffered and committed by flush() in one short transaction,
+        # the shards of a sharded extraction share the cache file: in WAL mode their reads do not wait for
+        # the writes, and a flush waits up to the timeout for the flush of another shard
+        self.pending = {}
+        self.touched = {}
+        self.connection = sqlite3.connect(filename, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS task_cache "
+                                "(tkiid TEXT PRIMARY KEY, schema TEXT, closed INTEGER, event TEXT, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS task_cache_last_used ON task_cache (last_used)")
+        self.connection.commit()
+
+    def get(self, tkiid):
+        row = self.pending.get(tkiid)
+        if row is not None:
+            row = row[1:4]
+        else:
+            row = self.connection.execute("SELECT schema, closed, event FROM task_cache WHERE tkiid = ?", (tkiid,)).fetchone()
+        if row is None or row[0] != self.schema:
+            self.misses += 1
+            return None
+        if not row[1]:
+            # open task, it has to be fetched again
+            self.revalidations += 1
+            return None
+        self.hits += 1
+        self.touched[tkiid] = time.time()
+        return json.loads(row[2])
+
+    def put(self, tkiid, event, closed):
+        self.pending[tkiid] = (tkiid, self.schema, int(closed), json.dumps(event), time.time())
+        self.touched.pop(tkiid, None)
+
+    # called after each page: the new events and the last_used of the hits are written in one transaction
+    def flush(self):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO task_cache (tkiid, schema, closed, event, last_used) "
+                                        "VALUES (?, ?, ?, ?, ?)", self.pending.values())
+            self.connection.executemany("UPDATE task_cache SET last_used = ? WHERE tkiid = ?",
+                                        [(last_used, tkiid) for tkiid, last_used in self.touched.items()])
+            self.pending = {}
+            self.touched = {}
+            count = self.connection.execute("SELECT COUNT(*) FROM task_cache").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM task_cache WHERE tkiid IN "
+                                        "(SELECT tkiid FROM task_cache ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+                self.evictions += count - self.max_entries
+
+    def report(self, logger):
+        message = (f"Task cache: {self.hits} hits, {self.misses} misses, {self.revalidations} open tasks revalidated, "
+                   f"{self.evictions} evicted")
+        print(message)
+        logger.info(message)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+# The cached events depend on the mapping, the included fields and the variables of the config
+def task_cache_schema(config):
+    schema = ["rows", config['BAW_fields']['process_mining_mapping'], config['BAW_fields']['included_task_data'],
+              config['task_data_variables'], config['export_exposed_variables'], config.get('exposed_variables', [])]
+    return hashlib.sha1(json.dumps(schema, sort_keys=True).encode('utf-8')).hexdigest()
+
+def is_closed_task(task_data):
+    return task_data.get('status') == 'Closed' or task_data.get('state') in ('STATE_FINISHED', 'STATE_CANCELED', 'STATE_DELETED')
+
+def open_task_cache(config, logger):
+    # config['task_cache_file'] == "" disables the cache
+    if config.get('task_cache_file', "") != "" and config.get('task_cache') is None:
+        config['task_cache'] = TaskCache(config['task_cache_file'], config.get('task_cache_max_entries', 1000000), config)
+        logger.info(f"Task cache: {config['task_cache_file']}")
+
+def close_task_cache(config, logger):
+    if config.get('task_cache') is not None:
+        config['task_cache'].report(logger)
+        config['task_cache'].close()
+        config['task_cache'] = None
+
+# Dead-letter file: the piids whose task summaries and the tkiids whose task details could not be fetched,
+# even after the retries. A later run with config['refetch_dead_letters'] fetches only them.
+# An entry is removed as soon as its instance or task is fetched successfully.
+class DeadLetters:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.instances = {}
+        self.tasks = {}
+        try:
+            with open(filename) as dead_letter_file:
+                content = json.load(dead_letter_file)
+            self.instances = {entry['piid']: entry for entry in content.get('instances', [])}
+            self.tasks = {entry['tkiid']: entry for entry in content.get('tasks', [])}
+        except FileNotFoundError:
+            pass
+        self.loaded = len(self.instances) + len(self.tasks)
+        self.added = 0
+        self.recovered = 0
+
+    def add_instance(self, piid, reason):
+        self.added += piid not in self.instances
+        self.instances[piid] = {"piid": piid, "reason": reason, "failed": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    def add_task(self, tkiid, reason):
+        self.added += tkiid not in self.tasks
+        self.tasks[tkiid] = {"tkiid": tkiid, "reason": reason, "failed": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    def discard_instance(self, piid):
+        self.recovered += self.instances.pop(piid, None) is not None
+
+    def discard_task(self, tkiid):
+        self.recovered += self.tasks.pop(tkiid, None) is not None
+
+    def merge(self, other):
+        self.instances.update(other.instances)
+        self.tasks.update(other.tasks)
+
+    def __len__(self):
+        return len(self.instances) + len(self.tasks)
+
+    def save(self):
+        if len(self) == 0:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            return
+        # write a temporary file and rename it, a crash never leaves a truncated dead-letter file
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as dead_letter_file:
+            json.dump({"instances": list(self.instances.values()), "tasks": list(self.tasks.values())}, dead_letter_file, indent=2)
+        os.replace(temp_filename, self.filename)
+
+    def report(self, logger):
+        message = (f"Dead letters: {len(self.instances)} instances and {len(self.tasks)} tasks to refetch in {self.filename} "
+                   f"({self.added} new, {self.recovered} recovered)")
+        print(message)
+        logger.info(message)
+
+def open_dead_letters(config, logger):
+    # config['dead_letter_file'] == "" disables the dead-letter file
+    if config.get('dead_letter_file', "") != "" and config.get('dead_letters') is None:
+        config['dead_letters'] = DeadLetters(config['dead_letter_file'])
+        if config['dead_letters'].loaded > 0:
+            logger.info(f"Dead letters: {config['dead_letters'].loaded} entries from a previous run in {config['dead_letter_file']}")
+
+def close_dead_letters(config, logger):
+    if config.get('dead_letters') is not None:
+        config['dead_letters'].save()
+        config['dead_letters'].report(logger)
+        config['dead_letters'] = None
+
+# Checkpoint of a paged extraction (config['checkpoint_file'], "" disables it): an SQLite file with the piids
+# of the search still to extract and the events of the pages already extracted. The piids are saved once
+# after the search, then each page removes its piids and adds its events in one transaction.
+# A run that finds the checkpoint of the same search (project, BPD, window, filters and event columns)
+# skips the search, restores the events and extracts the pending piids only; a page interrupted by a crash
+# is extracted again. The file is removed once the run is complete and its output is written
+class Checkpoint:
+
+    def __init__(self, filename, config, keep_open=False):
+        self.filename = filename
+        self.keep_open = keep_open
+        self.run_key = checkpoint_run_key(config)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoint_state (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoint_pending "
+                                "(position INTEGER PRIMARY KEY, piid TEXT, last_modification_time TEXT)")
+        # each page deletes its piids, without the index every delete scans the pending table
+        self.connection.execute("CREATE INDEX IF NOT EXISTS checkpoint_pending_piid ON checkpoint_pending (piid)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS checkpoint_events (position INTEGER PRIMARY KEY, event TEXT)")
+        self.discarded = self.state('run_key') not in (None, self.run_key)
+        if self.discarded:
+            self.reset()
+        self.pages = 0
+
+    def state(self, key):
+        row = self.connection.execute("SELECT value FROM checkpoint_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def reset(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM checkpoint_pending")
+            self.connection.execute("DELETE FROM checkpoint_events")
+            self.connection.execute("DELETE FROM checkpoint_state")
+
+    def pending_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM checkpoint_pending").fetchone()[0]
+
+    def event_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM checkpoint_events").fetchone()[0]
+
+    # After the search: all the instances of the run are pending
+    def start(self, instance_list, high_water_mark):
+        self.reset()
+        with self.connection:
+            self.connection.executemany("INSERT INTO checkpoint_pending (piid, last_modification_time) VALUES (?, ?)",
+                                        [(instance['piid'], instance.get('lastModificationTime')) for instance in instance_list])
+            self.connection.executemany("INSERT INTO checkpoint_state (key, value) VALUES (?, ?)",
+                                        [("run_key", json.dumps(self.run_key)), ("high_water_mark", json.dumps(high_water_mark))])
+
+    def complete_page(self, instance_list, events):
+        with self.connection:
+            self.connection.executemany("INSERT INTO checkpoint_events (event) VALUES (?)", [(json.dumps(event),) for event in events])
+            self.connection.executemany("DELETE FROM checkpoint_pending WHERE piid = ?", [(instance['piid'],) for instance in instance_list])
+        self.pages += 1
+
+    # Returns the pending instances, the events of the completed pages are appended to event_data
+    def resume(self, event_data, config, logger):
+        projection = get_task_projection(config)
+        event_count = 0
+        for (event,) in self.connection.execute("SELECT event FROM checkpoint_events ORDER BY position"):
+            event_data.append(projection.restore(json.loads(event)))
+            event_count += 1
+        instance_list = [{'piid': piid, 'lastModificationTime': last_modification_time} for piid, last_modification_time in
+                         self.connection.execute("SELECT piid, last_modification_time FROM checkpoint_pending ORDER BY position")]
+        config['pending_high_water_mark'] = self.state('high_water_mark')
+        message = f"Resuming from the checkpoint {self.filename}: {event_count} events restored, {len(instance_list)} instances to extract"
+        print(message)
+        logger.info(message)
+        return instance_list
+
+    def close(self):
+        complete = self.pending_count() == 0
+        self.connection.close()
+        if complete:
+            os.remove(self.filename)
+        return complete
+
+# The checkpoint of a run is only resumed by a run of the same search with the same event columns
+def checkpoint_run_key(config):
+    search = [config[key] for key in ('project', 'process_name', 'from_date', 'from_date_criteria', 'to_date', 'to_date_criteria',
+                                      'status_filter', 'instance_limit', 'offset')]
+    search.append([config.get('window_start'), config.get('window_end')])
+    return hashlib.sha1(json.dumps([search, task_cache_schema(config)], sort_keys=True).encode('utf-8')).hexdigest()
+
+def open_checkpoint(config, logger, keep_open=False):
+    if config.get('checkpoint_file', "") != "" and config.get('checkpoint') is None:
+        config['checkpoint'] = Checkpoint(config['checkpoint_file'], config, keep_open)
+        if config['checkpoint'].discarded:
+            logger.info(f"Checkpoint {config['checkpoint_file']} of another search discarded")
+
+# Called at the end of the extraction with end_of_extraction=True: a checkpoint opened by execute() or run_shard()
+# with keep_open stays open until they have built the DataFrame or written the CSV file.
+# The file is kept when instances are still pending (the run failed)
+def close_checkpoint(config, logger, end_of_extraction=False):
+    checkpoint = config.get('checkpoint')
+    if checkpoint is None or (end_of_extraction and checkpoint.keep_open):
         return
+    config['checkpoint'] = None
+    if checkpoint.close():
+        logger.info(f"Run complete after {checkpoint.pages} checkpointed pages, {checkpoint.filename} removed")
+    else:
+        message = f"Instances still pending in the checkpoint {checkpoint.filename}, the next run resumes from it"
+        print(message)
+        logger.warning(message)
+
+# Metrics of an extraction run, kept in config['metrics'] from the search to the last page:
+# per endpoint latency histograms, bytes received and status codes, the span of each phase
+# (first request sent .. last response received), the use of the connection pool, the events/s
+# and the CSV writing. Written at the end of the run to config['metrics_file'] (JSON) and to
+# config['metrics_prometheus_file'] in the Prometheus text format, for the node_exporter textfile collector
+METRIC_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+class ExtractionMetrics:
+
+    def __init__(self, config):
+        self.config = config
+        self.labels = {"project": config['project'], "bpd": config['process_name']}
+        self.started = time.monotonic()
+        self.finished = None
+        self.endpoints = {}
+        self.events = 0
+        self.pool = {}
+        self.csv = None
+
+    def endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = {"requests": 0, "bytes": 0, "latency_sum": 0.0, "buckets": [0] * len(METRIC_LATENCY_BUCKETS),
+                                    "status": {}, "first": None, "last": None}
+        return self.endpoints[name]
+
+    def observe_request(self, name, started, finished, status, body_size):
+        endpoint = self.endpoint(name)
+        latency = finished - started
+        endpoint['requests'] += 1
+        endpoint['bytes'] += body_size
+        endpoint['latency_sum'] += latency
+        for index, bound in enumerate(METRIC_LATENCY_BUCKETS):
+            if latency <= bound:
+                endpoint['buckets'][index] += 1
+                break
+        code = str(status) if status is not None else "error"
+        endpoint['status'][code] = endpoint['status'].get(code, 0) + 1
+        endpoint['first'] = started if endpoint['first'] is None else min(endpoint['first'], started)
+        endpoint['last'] = finished if endpoint['last'] is None else max(endpoint['last'], finished)
+
+    def observe_events(self, count):
+        self.events += count
+
+    def observe_pool(self, usage):
+        self.pool = dict(usage)
+
+    def observe_csv(self, event_count, csv_bytes, file_bytes, seconds):
+        self.csv = {"events": event_count, "csv_bytes": csv_bytes, "file_bytes": file_bytes, "seconds": seconds}
+
+    def summary(self):
+        finished = self.finished if self.finished is not None else time.monotonic()
+        duration = finished - self.started
+        endpoints = {}
+        for name, endpoint in self.endpoints.items():
+            endpoints[name] = {
+                "requests": endpoint['requests'],
+                "bytes": endpoint['bytes'],
+                "latency_sum": endpoint['latency_sum'],
+                "latency_average": endpoint['latency_sum'] / endpoint['requests'] if endpoint['requests'] > 0 else 0,
+                "latency_buckets": dict(zip([str(bound) for bound in METRIC_LATENCY_BUCKETS] + ["+Inf"],
+                                            self.cumulative_buckets(endpoint))),
+                "status": dict(endpoint['status']),
+                "phase_seconds": endpoint['last'] - endpoint['first'] if endpoint['first'] is not None else 0.0
+            }
+        return {
+            "labels": self.labels,
+            "duration_seconds": duration,
+            "events": self.events,
+            "events_per_second": self.events / duration if duration > 0 else 0,
+            "endpoints": endpoints,
+            "connection_pool": self.pool,
+            "csv": self.csv
+        }
+
+    def cumulative_buckets(self, endpoint):
+        buckets = []
+        total = 0
+        for count in endpoint['buckets']:
+            total += count
+            buckets.append(total)
+        buckets.append(endpoint['requests'])
+        return buckets
+
+    def prometheus_text(self):
+        summary = self.summary()
+        base_labels = ",".join(f'{name}="{prometheus_label_value(value)}"' for name, value in self.labels.items())
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for suffix, labels, value in samples:
+                all_labels = ",".join([base_labels] + [f'{label}="{prometheus_label_value(label_value)}"' for label, label_value in labels])
+                lines.append(f"{name}{suffix}{{{all_labels}}} {value}")
+
+        histogram = []
+        for name, endpoint in self.endpoints.items():
+            bounds = [str(bound) for bound in METRIC_LATENCY_BUCKETS] + ["+Inf"]
+            for bound, count in zip(bounds, self.cumulative_buckets(endpoint)):
+                histogram.append(("_bucket", [("endpoint", name), ("le", bound)], count))
+            histogram.append(("_sum", [("endpoint", name)], endpoint['latency_sum']))
+            histogram.append(("_count", [("endpoint", name)], endpoint['requests']))
+        metric("baw_extraction_request_duration_seconds", "histogram", "Latency of the BAW REST requests", histogram)
+        metric("baw_extraction_response_bytes_total", "counter", "Bytes received from BAW",
+               [("", [("endpoint", name)], endpoint['bytes']) for name, endpoint in self.endpoints.items()])
+        metric("baw_extraction_responses_total", "counter", "BAW REST responses by status code",
+               [("", [("endpoint", name), ("code", code)], count)
+                for name, endpoint in self.endpoints.items() for code, count in endpoint['status'].items()])
+        metric("baw_extraction_phase_seconds", "gauge", "Time from the first request to the last response of each phase",
+               [("", [("phase", name)], endpoint['phase_seconds']) for name, endpoint in summary['endpoints'].items()])
+        if self.pool:
+            metric("baw_extraction_in_flight_requests", "gauge", "Requests in flight, peak and average over the run",
+                   [("", [("stat", "peak")], self.pool['peak_in_flight']), ("", [("stat", "average")], self.pool['average_in_flight']),
+                    ("", [("stat", "limit")], self.pool['limit'])])
+        metric("baw_extraction_events_total", "counter", "Events extracted", [("", [], self.events)])
+        metric("baw_extraction_events_per_second", "gauge", "Events extracted per second", [("", [], summary['events_per_second'])])
+        metric("baw_extraction_duration_seconds", "gauge", "Duration of the extraction run", [("", [], summary['duration_seconds'])])
+        if self.csv is not None:
+            metric("baw_extraction_csv_seconds", "gauge", "Time spent writing the CSV output", [("", [], self.csv['seconds'])])
+            metric("baw_extraction_csv_bytes", "gauge", "Bytes of CSV written, before compression", [("", [], self.csv['csv_bytes'])])
+        metric("baw_extraction_last_run_timestamp_seconds", "gauge", "End of the last extraction run", [("", [], time.time())])
+        return "\n".join(lines) + "\n"
+
+    def write(self, logger):
+        # temporary file and rename: the textfile collector never reads a partial file
+        for filename, content in ((self.config.get('metrics_file', ""), lambda: json.dumps(self.summary(), indent=2)),
+                                  (self.config.get('metrics_prometheus_file', ""), self.prometheus_text)):
+            if filename == "":
+                continue
+            temp_filename = filename + ".tmp"
+            with open(temp_filename, 'w') as metrics_file:
+                metrics_file.write(content())
+            os.replace(temp_filename, filename)
+            logger.info(f"Metrics written to {filename}")
+
+    def report(self, logger):
+        summary = self.summary()
+        phases = ", ".join(f"{name} {endpoint['phase_seconds']:.2f} s ({endpoint['requests']} requests, "
+                           f"{endpoint['latency_average']*1000:.1f} ms average)" for name, endpoint in summary['endpoints'].items())
+        message = f"Run metrics: {summary['events']} events in {summary['duration_seconds']:.2f} s ({summary['events_per_second']:.1f} events/s), {phases}"
+        if self.csv is not None:
+            message += f", CSV {self.csv['seconds']:.2f} s"
+        print(message)
+        logger.info(message)
 
-    async with session.get(url, auth=auth, ssl=False) as task_summary_response:
-        task_summary_status = task_summary_response.status
-        if task_summary_status == 200:
-            task_summary_data = await task_summary_response.json()
-
-            task_list = []
-            for task_summary in task_summary_data['data']['tasks']:
-                task_id = task_summary['tkiid']
-                logger.debug(f"Instance {instance} found Task : {task_id}")
-                task_list.append(task_id)
-
-            # We have the instance + a list of its task id's
-            # Update the bpd_instance_dict that was passed from the calling function
-            instance['task_list'] = task_list
-            pbar.update(1)
-
+def prometheus_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
 
-async def get_instance_data(instance_list, event_data, config, logger):
-    # Dictionary to hold bpd instances and related tasks
-    bpd_instance_dict = {}
-    ## Replace bpd_instance_dict with the array of instances, where each instance is an object
+def open_metrics(config):
+    if config.get('metrics') is None:
+        config['metrics'] = ExtractionMetrics(config)
+        config['last_metrics'] = None
 
-    instance_count = len(instance_list)
-    print(f"Processing {instance_count} instances. Getting tasks for each instance ...")
-    logger.info(f"Processing {instance_count} instances. Getting tasks for each instance ...")
+# At the end of the run; with the CSV output the metrics are written again when the CSV file is closed
+def close_metrics(config, logger):
+    metrics = config.get('metrics')
+    if metrics is None:
+        return
+    metrics.finished = time.monotonic()
+    metrics.report(logger)
+    metrics.write(logger)
+    config['metrics'] = None
+    config['last_metrics'] = metrics
+
+# Profile of an extraction run (config['profile']), kept in config['profile_data'] from the start of the
+# extraction to the output: the time spent in each phase (scheduler_wait: waiting for a request slot,
+# network_wait: request sent .. body received, json_decode, projection, dataframe, csv_write), summed over
+# all the calls, so the phases of concurrent requests add up to more than the wall time.
+# config['profile_cpu'] samples the stack of the extraction every config['profile_sample_interval'] s of CPU time
+# (SIGPROF timer; when the extraction does not run in the main thread, a thread samples its stack every
+# config['profile_sample_interval'] s of wall time instead, biased towards the calls that release the GIL),
+# config['profile_memory'] traces the allocations with tracemalloc.
+# Written to <csvfilename>_profile.json next to the CSV output, with the sampled stacks in
+# <csvfilename>_profile.folded (one "frame;frame;frame count" line per stack, the flame graph input format)
+class ExtractionProfile:
+
+    def __init__(self, config, keep_open=False):
+        self.config = config
+        self.keep_open = keep_open
+        self.top = config.get('profile_top', 20)
+        self.phases = {}
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.wall = None
+        self.cpu = None
+        self.stacks = {}
+        self.samples = 0
+        self.sampler = None
+        self.sampling = threading.Event()
+        self.previous_handler = None
+        self.memory = None
+        self.tracemalloc_started = False
+        if config.get('profile_memory', False) and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracemalloc_started = True
+        if config.get('profile_cpu', False):
+            interval = config.get('profile_sample_interval', 0.005)
+            if hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread():
+                self.sampler = "signal"
+                self.previous_handler = signal.signal(signal.SIGPROF, lambda signum, frame: self.record(frame))
+                signal.setitimer(signal.ITIMER_PROF, interval, interval)
+            else:
+                self.sampler = threading.Thread(target=self.sample, args=(threading.get_ident(), interval), daemon=True)
+                self.sampler.start()
+
+    def add(self, phase, seconds, calls=1):
+        if phase not in self.phases:
+            self.phases[phase] = [0.0, 0]
+        self.phases[phase][0] += seconds
+        self.phases[phase][1] += calls
+
+    def sample(self, thread_id, interval):
+        while not self.sampling.wait(interval):
+            self.record(sys._current_frames().get(thread_id))
+
+    def record(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        stack = ";".join(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.started
+        self.cpu = time.process_time() - self.cpu_started
+        if self.sampler == "signal":
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.previous_handler)
+        elif self.sampler is not None:
+            self.sampling.set()
+            self.sampler.join()
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            self.memory = {
+                "traced_bytes": current,
+                "peak_traced_bytes": peak,
+                "top_allocators": [{"location": f"{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}",
+                                    "bytes": statistic.size, "blocks": statistic.count}
+                                   for statistic in snapshot.statistics('lineno')[:self.top]]
+            }
+            if self.tracemalloc_started:
+                tracemalloc.stop()
+
+    def cpu_profile(self):
+        if self.sampler is None:
+            return None
+        self_samples = {}
+        total_samples = {}
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_samples[frames[-1]] = self_samples.get(frames[-1], 0) + count
+            for frame in set(frames):
+                total_samples[frame] = total_samples.get(frame, 0) + count
+
+        def top(samples):
+            return [{"function": function, "samples": count, "share": count / self.samples}
+                    for function, count in sorted(samples.items(), key=lambda item: -item[1])[:self.top]]
+        return {"samples": self.samples, "interval": self.config.get('profile_sample_interval', 0.005),
+                "top_self": top(self_samples), "top_total": top(total_samples)}
+
+    def summary(self):
+        return {
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "phases": {phase: {"seconds": seconds, "calls": calls, "average_ms": seconds / calls * 1000 if calls > 0 else 0}
+                       for phase, (seconds, calls) in self.phases.items()},
+            "cpu_profile": self.cpu_profile(),
+            "memory": self.memory
+        }
+
+    def write(self, logger):
+        base = os.path.join(self.config['csvpath'], self.config['csvfilename'] + "_profile")
+        with open(base + ".json", 'w') as profile_file:
+            json.dump(self.summary(), profile_file, indent=2)
+        if self.sampler is not None:
+            with open(base + ".folded", 'w') as folded_file:
+                for stack, count in sorted(self.stacks.items()):
+                    folded_file.write(f"{stack} {count}\n")
+        phases = ", ".join(f"{phase} {seconds:.2f} s" for phase, (seconds, calls) in self.phases.items())
+        message = f"Profile: {self.wall:.2f} s wall, {self.cpu:.2f} s CPU, {phases}, written to {base}.json"
+        print(message)
+        logger.info(message)
 
-    # Initialise the connector
-    connector = aiohttp.TCPConnector(limit=config['thread_count'])
+def open_profile(config, keep_open=False):
+    if config.get('profile', False) and config.get('profile_data') is None:
+        config['profile_data'] = ExtractionProfile(config, keep_open)
 
-    # create a ClientTimeout to allow for long running jobs
+# Called at the end of the extraction with end_of_extraction=True: a profile opened by execute() or run_shard()
+# with keep_open stays open until they have built the DataFrame or written the CSV file
+def close_profile(config, logger, end_of_extraction=False):
+    profile = config.get('profile_data')
+    if profile is None or (end_of_extraction and profile.keep_open):
+        return
+    config['profile_data'] = None
+    profile.stop()
+    profile.write(logger)
+
+def profile_time(config, phase, started):
+    profile = config.get('profile_data')
+    if profile is not None:
+        profile.add(phase, time.perf_counter() - started)
+
+# Connector with the keep-alive, DNS cache and per host limit from the config
+def create_connector(config):
+    return aiohttp.TCPConnector(limit=config['thread_count'],
+                                limit_per_host=config.get('limit_per_host', 0),
+                                keepalive_timeout=config.get('keepalive_timeout', 15),
+                                use_dns_cache=config.get('use_dns_cache', True),
+                                ttl_dns_cache=config.get('ttl_dns_cache', 10))
+
+# The credentials are resolved once and attached to the session: in auth_mode "basic" every request
+# carries the same BasicAuth, in auth_mode "session" the requests carry the cookie of the login session instead
+def create_session(config, logger, trace_configs=None):
+    auth = None
+    if config.get('auth_mode', "basic") == "basic":
+        auth = get_aiohttp_BAW_auth(config, logger)
+        if auth == 0:
+            logger.error('ERROR getting Auth')
+            auth = None
+    # BAW is often addressed by its IP address, whose cookies are rejected by the default cookie jar
+    cookie_jar = aiohttp.CookieJar(unsafe=True)
+    # create a ClientTimeout to allow for long running jobs,
+    # config['request_timeout'] > 0 bounds the wait for each response, a request that times out is retried
+    request_timeout = config.get('request_timeout', 0) or None
     infinite_timeout = aiohttp.ClientTimeout(total=None , connect=None,
-                          sock_connect=None, sock_read=None)
-
-    # Get the task list for each instance
-    async with aiohttp.ClientSession(connector=connector, timeout=infinite_timeout) as session:
-        async_tasks = []
-        pbar = tqdm(total=instance_count)
-        for instance in instance_list:
-            async_task = asyncio.ensure_future(get_tasks(session, instance, pbar, config, logger))
-            async_tasks.append(async_task)
-
-        await asyncio.gather(*async_tasks)
-        pbar.close()
-
-    # Re-initialise the connector
-    connector = aiohttp.TCPConnector(limit=config['thread_count'])
-
-    # Calculate how many tasks exist in the dictionary
-
-    task_count = 0
-
-    for instance in instance_list:
-        task_count += len(instance['task_list'])
-    print(f"Processing {task_count} tasks. Creating an event from each task ...")
-    logger.info(f"Processing {task_count} tasks. Creating an event from each task ...")
-
-    async with aiohttp.ClientSession(connector=connector, timeout=infinite_timeout) as session:
-        async_tasks = []
+                          sock_connect=request_timeout, sock_read=request_timeout)
+    return aiohttp.ClientSession(connector=create_connector(config), timeout=infinite_timeout, trace_configs=trace_configs,
+                                 auth=auth, cookie_jar=cookie_jar)
+
+# Owns one event loop and one ClientSession for a whole execute() run, so the
+# connections to BAW, and their TLS handshakes, are reused across the paging loops
+class BAWExtractor:
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self.connections_created = 0
+        self.connections_reused = 0
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        self.session = self.loop.run_until_complete(self._create_session([trace_config]))
+        # one scheduler for the whole run, the adaptive limit carries over from one paging loop to the next
+        self.scheduler = create_request_scheduler(config, logger)
+
+    async def _create_session(self, trace_configs):
+        return create_session(self.config, self.logger, trace_configs)
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self.connections_reused += 1
+
+    def get_instance_data(self, instance_list, event_data):
+        self.loop.run_until_complete(get_instance_data(instance_list, event_data, self.config, self.logger, self.session, self.scheduler))
+
+    # Run coroutine_function(session, scheduler) in the event loop of the extractor
+    def run(self, coroutine_function):
+        return self.loop.run_until_complete(coroutine_function(self.session, self.scheduler))
+
+    def report(self):
+        message = (f"Connections to BAW: {self.connections_created} opened, {self.connections_reused} reused, "
+                   f"{self.connections_reused} handshakes saved")
+        print(message)
+        self.logger.info(message)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.report()
+        self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Uses the session of the extractor when there is one,
+# otherwise a session is opened for this call only
+async def get_instance_data(instance_list, event_data, config, logger, session=None, scheduler=None):
+    if session is None:
+        async with create_session(config, logger) as session:
+            await fetch_instance_data(session, instance_list, event_data, config, logger, scheduler=scheduler)
+    else:
+        await fetch_instance_data(session, instance_list, event_data, config, logger, scheduler=scheduler)
+
+# Run coroutine_function(session, scheduler) with the session and the scheduler of the extractor,
+# or with a session and a scheduler for this call only
+def run_with_session(coroutine_function, config, logger, extractor=None):
+    if extractor is not None:
+        return extractor.run(coroutine_function)
+
+    async def run():
+        async with create_session(config, logger) as session:
+            return await coroutine_function(session, create_request_scheduler(config, logger))
+    return asyncio.run(run())
+
+# With search=True, instance_list is empty and it is filled by the paginated search while the pipeline runs:
+# the instances of each search page go to the task summary workers as soon as the page arrives
+async def fetch_instance_data(session, instance_list, event_data, config, logger, search=False, scheduler=None):
+    instance_count = len(instance_list)
+    event_count = len(event_data)
+    if search:
+        print("Searching instances page by page. Getting tasks for each instance and creating an event from each task ...")
+        logger.info("Searching instances page by page. Getting tasks for each instance and creating an event from each task ...")
+    else:
+        print(f"Processing {instance_count} instances. Getting tasks for each instance and creating an event from each task ...")
+        logger.info(f"Processing {instance_count} instances. Getting tasks for each instance and creating an event from each task ...")
+
+    # The task summaries and the task details are fetched as a pipeline:
+    # the tkiids of an instance are queued for the detail workers as soon as its task list arrives,
+    # instead of waiting for all the task summaries before fetching the first task detail
+    instance_queue = asyncio.Queue()
+    task_queue = asyncio.Queue(maxsize=config.get('task_queue_size', 100))
+
+    # One scheduler bounds all the requests in flight, whatever the stage, task or instance they belong to
+    if scheduler is None:
+        scheduler = create_request_scheduler(config, logger)
+
+    # The task summary and the task detail requests share the connection pool of the session
+    instance_pbar = tqdm(total=instance_count, desc="Instances", position=0)
+    task_pbar = tqdm(total=0, desc="Tasks", position=1)
+
+    summary_worker_count = config['thread_count'] if search else min(config['thread_count'], instance_count)
+    summary_workers = []
+    for i in range(summary_worker_count):
+        summary_workers.append(asyncio.ensure_future(task_summary_worker(session, scheduler, instance_queue, task_queue, event_data, instance_pbar, task_pbar, config, logger)))
+    detail_workers = []
+    for i in range(config['thread_count']):
+        detail_workers.append(asyncio.ensure_future(task_detail_worker(session, scheduler, task_queue, event_data, task_pbar, config, logger)))
 
-        pbar = tqdm(total=task_count)
-        for instance in instance_list:
-            async_task = asyncio.ensure_future(create_events(session, instance, event_data, pbar, config, logger))
-            async_tasks.append(async_task)
-        await asyncio.gather(*async_tasks)
-        pbar.close()
+    try:
+        if search:
+            await search_instances(session, scheduler, instance_list, config, logger, instance_queue, instance_pbar)
+        else:
+            for instance in instance_list:
+                instance_queue.put_nowait(instance)
+        # tkiids of the dead-letter file go straight to the detail workers
+        refetch_task_ids = config.pop('refetch_task_ids', [])
+        task_pbar.total += len(refetch_task_ids)
+        for task_id in refetch_task_ids:
+            await task_queue.put(task_id)
+        # All the instances are queued, tell the task summary workers to stop once the queue is drained
+        for worker in summary_workers:
+            instance_queue.put_nowait(None)
+        await asyncio.gather(*summary_workers)
+        # All the tkiids are queued, tell the detail workers to stop once the queue is drained
+        for worker in detail_workers:
+            await task_queue.put(None)
+        await asyncio.gather(*detail_workers)
+    finally:
+        # a failed search or worker must not leave the other workers pending in the loop of the extractor
+        workers = summary_workers + detail_workers
+        for worker in workers:
+            if not worker.done():
+                worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        instance_pbar.close()
+        task_pbar.close()
+
+    task_count = task_pbar.total
+    print(f"Processed {task_count} tasks, {len(event_data) - event_count} events created")
+    logger.info(f"Processed {task_count} tasks, {len(event_data) - event_count} events created")
+    usage = scheduler.report(logger)
+    if config.get('metrics') is not None:
+        config['metrics'].observe_events(len(event_data) - event_count)
+        config['metrics'].observe_pool(usage)
+    if config.get('task_cache') is not None:
+        config['task_cache'].flush()
+    # saved after each page, the failures of a crashed run can be refetched too
+    if config.get('dead_letters') is not None:
+        config['dead_letters'].save()
+
+# The log records are put in a queue, a background thread formats them and writes config['logfile'],
+# the event loop never waits for the formatting or the disk
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # the record is formatted by the writer thread, not by the caller
+    def prepare(self, record):
+        return record
+
+# logger name -> (log file, queue listener, queue handler)
+log_listeners = {}
 
 def setup_logger(config, level):
     logger = logging.getLogger(__name__)
-    formatter = logging.Formatter('%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
-    file_handler = logging.FileHandler(config['logfile'])
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    logfile = os.path.abspath(config['logfile'])
+    current = log_listeners.get(logger.name)
+    # setup_logger is called for each extraction, the logger keeps a single handler
+    if current is None or current[0] != logfile:
+        if current is not None:
+            stop_logger(logger)
+        formatter = logging.Formatter('%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s')
+        file_handler = logging.FileHandler(config['logfile'])
+        file_handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        queue_handler = DeferredQueueHandler(log_queue)
+        logger.addHandler(queue_handler)
+        log_listeners[logger.name] = (logfile, listener, queue_handler)
     logger.setLevel(level)
     
     return logger
 
-def extract_baw_data(instance_list, event_data, config, logger): 
+# Writes the queued records and closes the log file. Called at exit and at the end of a shard
+# (the worker processes of the shards exit without running the atexit functions)
+def stop_logger(logger=None):
+    names = [logger.name] if logger is not None else list(log_listeners)
+    for name in names:
+        if name not in log_listeners:
+            continue
+        logfile, listener, queue_handler = log_listeners.pop(name)
+        logging.getLogger(name).removeHandler(queue_handler)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+atexit.register(stop_logger)
+
+# Bounded repr of the BAW payloads for the debug dumps: a search response of thousands of instances
+# is cut to a few items per list and dict and to config['log_payload_max_chars'] characters.
+# The repr is computed by the writer thread, only if the record is written
+class PayloadDump:
+    repr = reprlib.Repr()
+    repr.maxlevel = 4
+    repr.maxdict = 10
+    repr.maxlist = 10
+    repr.maxstring = 200
+    repr.maxother = 200
+
+    def __init__(self, payload, max_chars):
+        self.payload = payload
+        self.max_chars = max_chars
+
+    def __str__(self):
+        text = self.repr.repr(self.payload)
+        if self.max_chars and len(text) > self.max_chars:
+            text = text[:self.max_chars] + f"... ({len(text)} chars)"
+        return text
+
+dump_counter = 0
+
+# Logs one debug dump of payload out of config['log_payload_sample_rate']
+def debug_dump(logger, message, payload, config):
+    global dump_counter
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    dump_counter += 1
+    if (dump_counter - 1) % max(config.get('log_payload_sample_rate', 1), 1):
+        return
+    logger.debug(message + " %s", PayloadDump(payload, config.get('log_payload_max_chars', 2000)), stacklevel=2)
+
+# The task cache, the dead letters, the metrics and the profile of an extraction are opened at its start
+# and closed once all its instances are extracted, or when the extraction failed;
+# the high-water mark is only moved by a completed extraction
+def open_extraction(config, logger):
+    open_task_cache(config, logger)
+    open_dead_letters(config, logger)
+    open_metrics(config)
+    open_profile(config)
+    get_task_projection(config)
+
+def close_extraction(config, logger, completed=True):
+    close_task_cache(config, logger)
+    close_dead_letters(config, logger)
+    close_metrics(config, logger)
+    close_profile(config, logger, end_of_extraction=True)
+    close_checkpoint(config, logger, end_of_extraction=True)
+    config['task_projection'] = None
+    if completed and config.get('incremental', False):
+        if config.get('pending_high_water_mark') is not None:
+            save_high_water_mark(config, config['pending_high_water_mark'], logger)
+        else:
+            logger.info("No lastModificationTime in the search results, the high-water mark is not updated")
+
+def extract_baw_data(instance_list, event_data, config, logger, extractor=None): 
 
+    completed = False
     try:
         logger.info('Extraction from BAW starting')
+        streamed_search = False
+        open_extraction(config, logger)
+        open_checkpoint(config, logger)
+        checkpoint = config.get('checkpoint')
         # if instance_list size is 0, fetch the processes
-        if len(instance_list) == 0:
-            run_instance_list = get_instance_list([], config, logger)
+        if len(instance_list) == 0 and config.get('refetch_dead_letters', False):
+            # only the instances and the tasks of the dead-letter file, no search
+            dead_letters = config.get('dead_letters')
+            if dead_letters is None or len(dead_letters) == 0:
+                print("No dead letters to refetch")
+                logger.info("No dead letters to refetch")
+                completed = True
+                return instance_list
+            run_instance_list = [{'piid': piid} for piid in dead_letters.instances]
+            config['refetch_task_ids'] = list(dead_letters.tasks)
+            config['pending_high_water_mark'] = None
+            print(f"Refetching {len(run_instance_list)} instances and {len(config['refetch_task_ids'])} tasks from {config['dead_letter_file']}")
+            logger.info(f"Refetching {len(run_instance_list)} instances and {len(config['refetch_task_ids'])} tasks from {config['dead_letter_file']}")
+        elif len(instance_list) == 0 and checkpoint is not None and checkpoint.pending_count() > 0:
+            # a previous run of this search stopped before its end
+            run_instance_list = checkpoint.resume(event_data, config, logger)
+        elif len(instance_list) == 0:
+            if config.get('incremental', False):
+                config['high_water_mark'] = load_high_water_mark(config)
+                if config['high_water_mark'] is not None:
+                    print(f"Incremental extraction of the instances modified after {config['high_water_mark']}")
+                    logger.info(f"Incremental extraction of the instances modified after {config['high_water_mark']}")
+            paging = (config['loop_rate']>0 and config['paging_size']>0)
+            # with a checkpoint, the instances of the search are saved before they are extracted
+            if config.get('search_page_size', 0) > 0 and not paging and checkpoint is None:
+                # the instances of each search page are extracted as soon as the page arrives
+                run_instance_list = []
+                run_with_session(lambda session, scheduler: fetch_instance_data(session, run_instance_list, event_data, config, logger, search=True, scheduler=scheduler), config, logger, extractor)
+                streamed_search = True
+            elif config.get('search_page_size', 0) > 0:
+                run_instance_list = run_with_session(lambda session, scheduler: search_instances(session, scheduler, [], config, logger), config, logger, extractor)
+            else:
+                run_instance_list = get_instance_list([], config, logger)
+            # largest lastModificationTime of this search, saved once all its instances are extracted
+            modification_times = [instance['lastModificationTime'] for instance in run_instance_list if instance.get('lastModificationTime')]
+            config['pending_high_water_mark'] = max(modification_times) if len(modification_times) > 0 else None
             if (len(run_instance_list) == 0):
                 print("No instances match the search")
                 logger.info("No instances match the search")
+                completed = True
                 return instance_list
             else:
                 print(f"Found : {len(run_instance_list)} instances of BPD {config['process_name']} in project {config['project']}")
                 logger.info(f"Found : {len(run_instance_list)} instances of BPD {config['process_name']} in project {config['project']}")
+                if checkpoint is not None:
+                    checkpoint.start(run_instance_list, config['pending_high_water_mark'])
         else:
             # we use another loop to fetch data from the instance list
             run_instance_list = instance_list
@@ -351,11 +1977,31 @@ def extract_baw_data(instance_list, event_data, config, logger):
             instance_list = []
 
         # get_instance_data() calls get_task_summaries() then get_task_details()
-        asyncio.run(get_instance_data(run_instance_list, event_data, config, logger))
+        # The extractor keeps the event loop and the connections open between the paging loops
+        # (already done during a streamed search)
+        # With a checkpoint, the events of the page are saved in the checkpoint before they are passed on
+        page_events = [] if checkpoint is not None else event_data
+        if streamed_search:
+            pass
+        elif extractor is not None:
+            extractor.get_instance_data(run_instance_list, page_events)
+        else:
+            asyncio.run(get_instance_data(run_instance_list, page_events, config, logger))
+        if checkpoint is not None:
+            checkpoint.complete_page(run_instance_list, page_events)
+            for event in page_events:
+                event_data.append(event)
+
+        # All the instances of the search are extracted
+        completed = (instance_list == [])
 
     except Exception as e:
         logger.info('There was an error in the execution'+str(e))
         print("--- There was an error in the execution: "+str(e))
+    finally:
+        # after the early returns and the errors too, nothing of a finished run is left in the config
+        if instance_list == []:
+            close_extraction(config, logger, completed)
             
     print("Still %s instances to process" % len(instance_list))
     logger.info("Still %s instances to process" % len(instance_list))
@@ -364,47 +2010,493 @@ def extract_baw_data(instance_list, event_data, config, logger):
 
 
 
-def file_compress(file_to_write, out_zip_file):
-    # Select the compression mode ZIP_DEFLATED for compression
-    # or zipfile.ZIP_STORED to just store the file
-    compression = zipfile.ZIP_DEFLATED
-    # create the zip file first parameter path/name, second mode
-    # print(f' *** out_zip_file is - {out_zip_file}')
-    zf = zipfile.ZipFile(out_zip_file, mode="w")
-    try:
-        # Add file to the zip file
-        # first parameter file to zip, second filename in zip
-        # print(f' *** Processing file {file_to_write}')
-        zf.write(file_to_write, file_to_write, compress_type=compression)
-
-    except FileNotFoundError as e:
-        print(f' *** Exception occurred during zip process - {e}')
-    finally:
-        # Don't forget to close the file!
-        zf.close()
+# Counts the bytes written through it, below the text layer of the CSV output
+class CountingStream(io.RawIOBase):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.stream.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+        super().close()
+
+# Streaming CSV output: the fetch workers append each event as soon as it is created and it is written
+# right away, so the events of the extraction are never all held in memory.
+# The rows are compressed as they are written (config['csv_compression']: "zip", "gzip" or "none"),
+# the data is serialised once and there is no temporary CSV file.
+# The columns are fixed up front from the config, a column without a value gets "" and
+# the tracked fields that are not in the columns are ignored (logged once).
+# With export_exposed_variables, the trkd.* columns are those of config['exposed_variables'], which must list them
+class CSVEventSink:
+
+    def __init__(self, config, logger=None):
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.config = config
+        if config['export_exposed_variables'] == True and len(config.get('exposed_variables', [])) == 0:
+            raise ValueError("export_exposed_variables with the CSV output needs the tracked fields listed in exposed_variables")
+        self.columns = get_task_projection(config).columns
+        self.compression = config.get('csv_compression', "zip")
+        self.csvname = config['csvfilename']+".csv"
+        if self.compression == "zip":
+            self.filename = os.path.join(config['csvpath'], config['csvfilename']+".zip")
+        elif self.compression == "gzip":
+            self.filename = os.path.join(config['csvpath'], self.csvname+".gz")
+        else:
+            self.filename = os.path.join(config['csvpath'], self.csvname)
+        # the file is created with the first event, a run without events leaves the previous output in place
+        self.csv_writer = None
+        self.closed = False
+        self.write_time = 0.0
+        self.event_count = 0
+        self.ignored_keys = set()
+
+    def create_file(self):
+        compression_level = self.config.get('compression_level', 6)
+        if self.compression == "zip":
+            self.zip_file = zipfile.ZipFile(self.filename, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=compression_level)
+            stream = self.zip_file.open(self.csvname, mode="w", force_zip64=True)
+        elif self.compression == "gzip":
+            stream = gzip.open(self.filename, mode="wb", compresslevel=compression_level)
+        else:
+            stream = open(self.filename, mode="wb")
+        self.counting_stream = CountingStream(stream)
+        self.data_file = io.TextIOWrapper(self.counting_stream, encoding='utf-8', newline='')
+        self.csv_writer = csv.writer(self.data_file)
+        self.csv_writer.writerow(self.columns)
+
+    def append(self, event):
+        extra_fields = event[-1]
+        if extra_fields is not None and extra_fields.keys() - self.ignored_keys:
+            self.ignored_keys |= extra_fields.keys()
+            self.logger.warning(f"Event keys not in the CSV columns, ignored: {sorted(extra_fields.keys())}")
+        self.write_values(event[:-1])
+
+    # values in the order of the columns, None is written as ""
+    def write_values(self, values):
+        if self.csv_writer is None:
+            self.create_file()
+        start = time.perf_counter()
+        self.csv_writer.writerow(values)
+        self.write_time += time.perf_counter() - start
+        self.event_count += 1
+
+    def __len__(self):
+        return self.event_count
+
+    # Close the output file, returns its name, None when there was no event to write
+    def close(self):
+        if self.csv_writer is None:
+            if not self.closed:
+                print("No events extracted")
+                self.logger.info("No events extracted")
+                self.closed = True
+            return None
+        if self.closed:
+            return self.filename
+        self.closed = True
+        start = time.perf_counter()
+        self.data_file.close()
+        if self.compression == "zip":
+            self.zip_file.close()
+        self.write_time += time.perf_counter() - start
+        csv_bytes = self.counting_stream.bytes_written
+        file_bytes = os.path.getsize(self.filename)
+        throughput = csv_bytes / self.write_time / 1e6 if self.write_time > 0 else 0
+        message = (f"{self.event_count} events written to {self.filename}: {csv_bytes} CSV bytes, {file_bytes} bytes written "
+                   f"({file_bytes / csv_bytes if csv_bytes > 0 else 0:.1%}), {throughput:.1f} MB/s")
+        print(message)
+        self.logger.info(message)
+        # the run is over when the file is closed after the extraction, its metrics are written again with the CSV
+        metrics = self.config.get('metrics')
+        if metrics is None and self.config.get('last_metrics') is not None:
+            metrics = self.config['last_metrics']
+            metrics.observe_csv(self.event_count, csv_bytes, file_bytes, self.write_time)
+            metrics.write(self.logger)
+        elif metrics is not None:
+            metrics.observe_csv(self.event_count, csv_bytes, file_bytes, self.write_time)
+        if self.config.get('profile_data') is not None:
+            self.config['profile_data'].add("csv_write", self.write_time, self.event_count)
+        return self.filename
 
 def generate_csv_file(event_data, config):
-    # event_data contains an array of events as json objects
+    # event_data contains an array of event rows
     if (len(event_data) == 0):
         print("No events extracted")
         return
 
-    cwd = os.getcwd()
-    os.chdir(config['csvpath'])    
-    filename = config['csvfilename']+".csv"
-    zipfilename = config['csvfilename']+".zip"
-
-    data_file = open(filename, 'w')
-    csv_writer = csv.writer(data_file)
-    header=event_data[0].keys()
-    csv_writer.writerow(header)
+    csv_sink = CSVEventSink(config)
     for event in event_data:
-        csv_writer.writerow(event.values())
-    data_file.close()
-    
-    file_compress(filename, zipfilename)
-    os.chdir(cwd)
-    return config['csvpath']+zipfilename
+        csv_sink.append(event)
+    return csv_sink.close()
+
+
+# Sharded extraction: the from_date..to_date window is split into sub-windows (config['shard_by']: "day", "week",
+# "equal" for config['shard_count'] equal sub-windows, or "count" for sub-windows of at most config['shard_instances']
+# instances, counted with the overview.Total of the search), each one extracted by extract_baw_data in its own
+# worker process with its own connection pool, log file and CSV file. The shard files are then merged in
+# window order, the rows of each shard sorted, into the output of the config.
+# The sub-windows are on the attribute of from_date_criteria (createdAfter/createdBefore or
+# modifiedAfter/modifiedBefore), the configured to_date bound is kept on top of them, so the shards find the
+# instances of the unsharded search. The windows overlap by one second so no instance falls between two shards,
+# and the tasks found by two shards are only written once. With the DataFrame output, the shards write their
+# event rows as JSON lines instead of CSV, so the merged DataFrame has the types of an unsharded run.
+# Sharding does not combine with incremental extraction, execute() refuses the two together.
+BAW_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+def count_window_instances(config, window_start, window_end):
+    window_config = dict(config)
+    window_config['window_start'] = window_start.strftime(BAW_TIME_FORMAT)
+    window_config['window_end'] = window_end.strftime(BAW_TIME_FORMAT)
+    url = build_instance_search_url(window_config, 0, 1)
+    response = requests.get(url, auth=config['auth_data'], verify=False)
+    if response.status_code != 200:
+        raise RuntimeError(f"Count of the instances from {window_config['window_start']} to {window_config['window_end']}: "
+                           f"{baw_error_message(response.status_code, response.text)}")
+    return response.json()['data']['overview']['Total']
+
+# Halve the window until each part has at most config['shard_instances'] instances, the empty parts are dropped
+def split_window_by_count(config, window_start, window_end, logger):
+    instance_count = count_window_instances(config, window_start, window_end)
+    logger.debug("%d instances from %s to %s", instance_count, window_start, window_end)
+    if instance_count == 0:
+        return []
+    if instance_count <= config['shard_instances'] or window_end - window_start <= timedelta(seconds=2):
+        return [window_start]
+    middle = window_start + timedelta(seconds=int((window_end - window_start).total_seconds() // 2))
+    return split_window_by_count(config, window_start, middle, logger) + split_window_by_count(config, middle, window_end, logger)
+
+def shard_windows(config, logger):
+    start = datetime.strptime(config['from_date'], BAW_TIME_FORMAT)
+    end = datetime.strptime(config['to_date'], BAW_TIME_FORMAT)
+    if config['shard_by'] == "count":
+        boundaries = split_window_by_count(config, start, end, logger)
+        # the window of a part ends where the next one starts
+        windows = []
+        for i in range(len(boundaries)):
+            windows.append((boundaries[i], boundaries[i + 1] if i + 1 < len(boundaries) else end))
+        return windows
+    if config['shard_by'] == "equal":
+        step = (end - start) / config['shard_count']
+        boundaries = [start + step * i for i in range(config['shard_count'])]
+    else:
+        period = timedelta(weeks=1) if config['shard_by'] == "week" else timedelta(days=1)
+        # the sub-windows start at midnight, on monday for weeks
+        boundary = datetime(start.year, start.month, start.day)
+        if config['shard_by'] == "week":
+            boundary = boundary - timedelta(days=boundary.weekday())
+        boundaries = [start]
+        boundary = boundary + period
+        while boundary < end:
+            boundaries.append(boundary)
+            boundary = boundary + period
+    boundaries.append(end)
+    return [(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) if boundaries[i] < boundaries[i + 1]]
+
+# Objects of the run are not passed to the worker processes, they are created again by each shard
+RUNTIME_CONFIG_KEYS = ['auth_data', 'task_cache', 'task_projection', 'high_water_mark', 'pending_high_water_mark',
+                       'dead_letters', 'refetch_task_ids', 'metrics', 'last_metrics', 'profile_data', 'checkpoint']
+
+def shard_config(config, index, window):
+    shard = {key: value for key, value in config.items() if key not in RUNTIME_CONFIG_KEYS}
+    window_start, window_end = window
+    if index > 0:
+        window_start = window_start - timedelta(seconds=1)
+    shard['window_start'] = window_start.strftime(BAW_TIME_FORMAT)
+    shard['window_end'] = window_end.strftime(BAW_TIME_FORMAT)
+    base, extension = os.path.splitext(config['logfile'])
+    shard['logfile'] = f"{base}_shard{index:03d}{extension}"
+    shard['csvfilename'] = f"{config['csvfilename']}_shard{index:03d}"
+    shard['csv_compression'] = "none"
+    # the shards write their own dead-letter file, merged into config['dead_letter_file'] at the end
+    if config.get('dead_letter_file', "") != "":
+        base, extension = os.path.splitext(config['dead_letter_file'])
+        shard['dead_letter_file'] = f"{base}_shard{index:03d}{extension}"
+    # one JSON metrics file per shard, the Prometheus textfile is left to the runs that are not sharded
+    if config.get('metrics_file', "") != "":
+        base, extension = os.path.splitext(config['metrics_file'])
+        shard['metrics_file'] = f"{base}_shard{index:03d}{extension}"
+    shard['metrics_prometheus_file'] = ""
+    if config.get('checkpoint_file', "") != "":
+        base, extension = os.path.splitext(config['checkpoint_file'])
+        shard['checkpoint_file'] = f"{base}_shard{index:03d}{extension}"
+    return shard
+
+# Executed in the worker process of the shard, returns the shard CSV file name
+def run_shard(config):
+    logger = setup_logger(config, logging.DEBUG)
+    config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
+    logger.info(f"Shard {config['window_start']} .. {config['window_end']}")
+    try:
+        open_profile(config, keep_open=True)
+        open_checkpoint(config, logger, keep_open=True)
+        event_sink = CSVEventSink(config, logger) if config['output_format'] == "csv" else RowFileSink(config)
+        instance_list = []
+        with BAWExtractor(config, logger) as extractor:
+            while(1):
+                instance_list = extract_baw_data(instance_list, event_sink, config, logger, extractor)
+                if instance_list == []:
+                    break
+        filename = event_sink.close()
+        close_checkpoint(config, logger)
+        close_profile(config, logger)
+        return filename
+    finally:
+        stop_logger(logger)
+
+def merge_shards(shard_files, config, logger):
+    csv_sink = CSVEventSink(config, logger)
+    seen_tasks = set()
+    # the shard files have the columns of the merged file
+    column_index = {column: index for index, column in enumerate(csv_sink.columns)}
+    def column(row, name):
+        return row[column_index[name]] if name in column_index else ""
+    for filename in shard_files:
+        # a shard without events has no file
+        if filename is None:
+            continue
+        with open(filename, newline='') as shard_file:
+            reader = csv.reader(shard_file)
+            next(reader, None)
+            rows = sorted(reader, key=lambda row: (column(row, 'process_ID'), column(row, 'start_date'), column(row, 'tkiid')))
+        for row in rows:
+            task_key = column(row, 'tkiid') or tuple(row)
+            if task_key in seen_tasks:
+                continue
+            seen_tasks.add(task_key)
+            csv_sink.write_values(row)
+        os.remove(filename)
+    return csv_sink.close()
+
+# Event rows of a shard with the DataFrame output, one JSON row per line
+class RowFileSink:
+
+    def __init__(self, config):
+        self.filename = os.path.join(config['csvpath'], config['csvfilename']+".jsonl")
+        self.row_file = open(self.filename, 'w')
+        self.event_count = 0
+
+    def append(self, event):
+        self.row_file.write(json.dumps(event) + "\n")
+        self.event_count += 1
+
+    def __len__(self):
+        return self.event_count
+
+    def close(self):
+        self.row_file.close()
+        return self.filename
+
+def merge_shard_rows(shard_files, config, logger):
+    started = time.perf_counter()
+    projection = get_task_projection(config)
+    accumulator = EventAccumulator(projection.columns)
+    seen_tasks = set()
+    column_index = {column: index for index, column in enumerate(projection.columns)}
+    def column(row, name):
+        value = row[column_index[name]] if name in column_index else None
+        return "" if value is None else str(value)
+    for filename in shard_files:
+        with open(filename) as shard_file:
+            rows = sorted((projection.restore(json.loads(line)) for line in shard_file),
+                          key=lambda row: (column(row, 'process_ID'), column(row, 'start_date'), column(row, 'tkiid')))
+        page = []
+        for row in rows:
+            task_key = column(row, 'tkiid') or json.dumps(row)
+            if task_key in seen_tasks:
+                continue
+            seen_tasks.add(task_key)
+            page.append(row)
+        accumulator.add_page(page)
+        os.remove(filename)
+    df = accumulator.dataframe()
+    profile_time(config, "dataframe", started)
+    logger.info(f"{accumulator.event_count} events merged from {len(shard_files)} shards")
+    return df
+
+# Returns the merged CSV file name, or the merged DataFrame
+def extract_sharded(config, logger):
+    config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
+    windows = shard_windows(config, logger)
+    message = f"Sharded extraction: {len(windows)} shards by {config['shard_by']}, {config['shard_workers']} worker processes"
+    print(message)
+    logger.info(message)
+    shard_configs = [shard_config(config, index, window) for index, window in enumerate(windows)]
+    # spawn: the workers do not inherit the event loop, the sockets or the threads of this process
+    with ProcessPoolExecutor(max_workers=config['shard_workers'], mp_context=multiprocessing.get_context("spawn")) as executor:
+        shard_files = list(executor.map(run_shard, shard_configs))
+    if config.get('dead_letter_file', "") != "":
+        dead_letters = DeadLetters(config['dead_letter_file'])
+        for shard in shard_configs:
+            if os.path.exists(shard['dead_letter_file']):
+                dead_letters.merge(DeadLetters(shard['dead_letter_file']))
+                os.remove(shard['dead_letter_file'])
+        dead_letters.save()
+        dead_letters.report(logger)
+    if config['output_format'] == "csv":
+        return merge_shards(shard_files, config, logger)
+    return merge_shard_rows(shard_files, config, logger)
+
+
+# Batch extraction: the jobs of a YAML file are extracted together by one event loop, over one connection pool
+# and one login, instead of one process per BPD. defaults holds the keys of default_config shared by the jobs
+# (root_url, user and password are the ones of the defaults for all the jobs), each job has a name and its own keys:
+#
+#   defaults:
+#     root_url: https://baw.example.com:9443
+#     thread_count: 20
+#     csvpath: /data/baw/
+#   jobs:
+#     - name: open_position
+#       project: HSS
+#       process_name: Standard HR Open New Position
+#       from_date: 2022-10-08T23:44:44Z
+#       to_date: 2022-11-23T22:33:33Z
+#     - name: onboarding
+#       ...
+#
+# thread_count of the defaults is the size of the shared pool, thread_count of a job caps the requests in flight
+# of the job, and the slots of the pool are shared fairly between the jobs (SharedRequestPool).
+# Each job writes its CSV file (csvfilename: the job name) and its own dead-letter, metrics and task cache files
+# (the names of the defaults suffixed with the job name). The jobs use the paginated search, page by page,
+# and a failed job does not stop the others. The combined report goes to config['batch_report_file'] in csvpath
+BATCH_JOB_FILE_KEYS = ['dead_letter_file', 'metrics_file', 'metrics_prometheus_file', 'task_cache_file']
+BATCH_SEARCH_PAGE_SIZE = 250
+
+def load_batch(batch_file):
+    with open(batch_file) as yaml_file:
+        batch = yaml.load(yaml_file, Loader=SafeLoader)
+    if not isinstance(batch, dict) or not isinstance(batch.get('jobs'), list) or len(batch['jobs']) == 0:
+        raise ValueError(f"{batch_file}: no jobs list")
+    names = [job.get('name') for job in batch['jobs']]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError(f"{batch_file}: each job needs its own name")
+    return batch.get('defaults') or {}, batch['jobs']
+
+def batch_job_config(config, job):
+    job_config = {key: value for key, value in config.items() if key not in RUNTIME_CONFIG_KEYS}
+    job_config.update(job)
+    name = job['name']
+    # YAML reads the unquoted dates as datetimes
+    for key in ('from_date', 'to_date'):
+        if isinstance(job_config[key], datetime):
+            job_config[key] = job_config[key].strftime(BAW_TIME_FORMAT)
+    if 'csvfilename' not in job:
+        job_config['csvfilename'] = name
+    for key in BATCH_JOB_FILE_KEYS:
+        if key not in job and config.get(key, "") != "":
+            base, extension = os.path.splitext(config[key])
+            job_config[key] = f"{base}_{name}{extension}"
+    if job_config.get('search_page_size', 0) <= 0:
+        job_config['search_page_size'] = BATCH_SEARCH_PAGE_SIZE
+    job_config['thread_count'] = min(job_config['thread_count'], config['thread_count'])
+    # one SIGPROF timer and one tracemalloc per process, the jobs run concurrently
+    job_config['profile'] = False
+    job_config['refetch_dead_letters'] = False
+    job_config['auth_data'] = config['auth_data']
+    return job_config
+
+# The log lines of a job start with its name
+class JobLogger(logging.LoggerAdapter):
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['job']}] {msg}", kwargs
+
+async def extract_job(session, pool, session_login, job_config, logger):
+    started = time.monotonic()
+    logger = JobLogger(logger, {"job": job_config['name']})
+    result = {"name": job_config['name'], "project": job_config['project'], "process_name": job_config['process_name'],
+              "from_date": job_config['from_date'], "to_date": job_config['to_date'], "status": "ok", "error": None,
+              "file": None, "instances": 0, "events": 0, "requests": 0, "retries": 0, "dead_letters": 0}
+    event_sink = None
+    completed = False
+    try:
+        open_extraction(job_config, logger)
+        if job_config.get('incremental', False):
+            job_config['high_water_mark'] = load_high_water_mark(job_config)
+        scheduler = create_request_scheduler(job_config, logger)
+        scheduler.pool = pool
+        scheduler.session_login = session_login
+        event_sink = CSVEventSink(job_config, logger)
+        instance_list = []
+        await fetch_instance_data(session, instance_list, event_sink, job_config, logger, search=True, scheduler=scheduler)
+        modification_times = [instance['lastModificationTime'] for instance in instance_list if instance.get('lastModificationTime')]
+        job_config['pending_high_water_mark'] = max(modification_times) if len(modification_times) > 0 else None
+        if job_config.get('dead_letters') is not None:
+            result['dead_letters'] = len(job_config['dead_letters'])
+        completed = True
+        result.update(instances=len(instance_list), requests=scheduler.requests, retries=scheduler.retries)
+    except Exception as e:
+        result.update(status="failed", error=str(e))
+        print(f"--- Job {job_config['name']} failed: {e}")
+        logger.error(f"Job failed: {e}")
+    finally:
+        close_extraction(job_config, logger, completed)
+    if event_sink is not None:
+        result['file'] = event_sink.close()
+        result['events'] = len(event_sink)
+    result['duration_seconds'] = time.monotonic() - started
+    return result
+
+async def run_batch_jobs(session, scheduler, job_configs, config, logger):
+    pool = SharedRequestPool(config['thread_count'])
+    # the jobs share the cookie jar of the session, and the login session in auth_mode "session"
+    return await asyncio.gather(*[extract_job(session, pool, scheduler.session_login, job_config, logger)
+                                  for job_config in job_configs])
+
+def write_batch_report(report, config, logger):
+    filename = os.path.join(config['csvpath'], config['batch_report_file'])
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    os.replace(temp_filename, filename)
+    lines = [f"Batch of {report['totals']['jobs']} jobs: {report['totals']['events']} events, {report['totals']['requests']} requests, "
+             f"{report['totals']['failed']} failed, {report['duration_seconds']:.2f} s, report written to {filename}"]
+    for job in report['jobs']:
+        lines.append(f"  {job['name']}: {job['status']}, {job['events']} events from {job['instances']} instances, "
+                     f"{job['requests']} requests, {job['retries']} retries, {job['dead_letters']} dead letters, "
+                     f"{job['duration_seconds']:.2f} s, {job['file'] if job['error'] is None else job['error']}")
+    for line in lines:
+        print(line)
+        logger.info(line)
+
+# Entry function of a batch, returns the combined report
+def execute_batch(batch_file):
+    defaults, jobs = load_batch(batch_file)
+    config = dict(default_config)
+    config.update(defaults)
+    config['BAW_fields'] = baw_fields
+    logger = setup_logger(config, logging.DEBUG)
+    config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
+    job_configs = [batch_job_config(config, job) for job in jobs]
+    message = f"Batch {batch_file}: {len(job_configs)} jobs over {config['thread_count']} shared connections"
+    print(message)
+    logger.info(message)
+    started = time.monotonic()
+    with BAWExtractor(config, logger) as extractor:
+        results = extractor.run(lambda session, scheduler: run_batch_jobs(session, scheduler, job_configs, config, logger))
+        connections = {"opened": extractor.connections_created, "reused": extractor.connections_reused}
+    report = {
+        "batch_file": batch_file,
+        "duration_seconds": time.monotonic() - started,
+        "thread_count": config['thread_count'],
+        "connections": connections,
+        "totals": {"jobs": len(results), "failed": sum(1 for result in results if result['status'] != "ok"),
+                   "events": sum(result['events'] for result in results),
+                   "requests": sum(result['requests'] for result in results)},
+        "jobs": results
+    }
+    write_batch_report(report, config, logger)
+    return report
 
 
 # This is the entry function for the logic file.
@@ -424,6 +2516,53 @@ default_config = {
         "status_filter": "",
         "loop_rate": 1,
         "thread_count": 10,
+        "task_queue_size": 100,
+        "adaptive_concurrency": False,
+        "adaptive_initial_limit": 2,
+        "adaptive_window": 20,
+        "adaptive_latency_tolerance": 1.5,
+        "request_timeout": 0,
+        "retry_count": 3,
+        "retry_backoff": 0.5,
+        "retry_max_backoff": 30,
+        "circuit_breaker_threshold": 10,
+        "circuit_breaker_reset_timeout": 30,
+        "dead_letter_file": "",
+        "metrics_file": "",
+        "metrics_prometheus_file": "",
+        "auth_mode": "basic",
+        "login_lifetime": 7200,
+        "log_payload_max_chars": 2000,
+        "log_payload_sample_rate": 1,
+        "profile": False,
+        "profile_cpu": False,
+        "profile_sample_interval": 0.005,
+        "profile_memory": False,
+        "profile_top": 20,
+        "task_detail_mode": "single",
+        "bulk_task_count": 50,
+        "refetch_dead_letters": False,
+        "limit_per_host": 0,
+        "keepalive_timeout": 60,
+        "use_dns_cache": True,
+        "ttl_dns_cache": 300,
+        "search_page_size": 0,
+        "incremental": False,
+        "state_file": "baw_extraction_state.json",
+        "task_cache_file": "",
+        "checkpoint_file": "",
+        "task_cache_max_entries": 1000000,
+        "exposed_variables": [],
+        "output_format": "dataframe",
+        "csvpath": "",
+        "csvfilename": "baw_events",
+        "csv_compression": "zip",
+        "shard_by": "",
+        "shard_count": 4,
+        "shard_instances": 1000,
+        "shard_workers": 4,
+        "batch_report_file": "baw_batch_report.json",
+        "compression_level": 6,
         "instance_limit": 0,
         "offset": 0,
         "logfile": "logs.log",
@@ -434,27 +2573,97 @@ default_config = {
         "export_exposed_variables": False
     }
 
+# DataFrame of event rows, the tracked fields that are not in config['exposed_variables'] are put after the other tracked fields
+def event_rows_dataframe(rows, columns):
+    df = pd.DataFrame.from_records(rows, columns=columns + ["_extra_fields"])
+    extra_fields = df.pop("_extra_fields")
+    if extra_fields.notna().any():
+        extra_df = pd.DataFrame([fields or {} for fields in extra_fields], index=df.index)
+        variable_columns = [column for column in columns if column.startswith("tsk.")]
+        df = pd.concat([df.drop(columns=variable_columns), extra_df, df[variable_columns]], axis=1)
+    return df
+
+# Each page of events is converted into a DataFrame chunk once, and the chunks are concatenated once
+# at the end, instead of rebuilding a DataFrame of all the events at every paging loop
+class EventAccumulator:
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.chunks = []
+        self.event_count = 0
+
+    def add_page(self, events):
+        if len(events) > 0:
+            self.chunks.append(event_rows_dataframe(events, self.columns))
+            self.event_count += len(events)
+
+    def dataframe(self):
+        if len(self.chunks) == 0:
+            return pd.DataFrame()
+        return pd.concat(self.chunks, ignore_index=True)
+
+
 def execute(context):
 
     config = default_config
     config['BAW_fields'] = baw_fields
     logger = setup_logger(config, logging.DEBUG)
-    event_list = []
+    # output_format "csv": the events are streamed to the CSV file instead of being kept for the DataFrame
+    csv_output = (config['output_format'] == "csv")
+    # shard_by set: the extraction runs in worker processes, one per sub-window, merged into one output file
+    # (a refetch of the dead letters has no time window to shard)
+    sharded = config['shard_by'] != "" and not config.get('refetch_dead_letters', False)
+    # the shards search their sub-window of from_date..to_date, not the instances modified after the high-water mark
+    if sharded and config.get('incremental', False):
+        raise ValueError("incremental extraction is not supported with shard_by, unset one of them")
+    # profile: the profile covers the extraction and the output, it is written once the output is done
+    open_profile(config, keep_open=True)
+
+    if sharded:
+        output = extract_sharded(config, logger)
+        close_profile(config, logger)
+        return output
+
+    # checkpoint_file: the run resumes from the checkpoint of a run stopped before its end
+    open_checkpoint(config, logger, keep_open=True)
+    if csv_output:
+        event_list = CSVEventSink(config, logger)
+    else:
+        event_list = []
+    accumulator = EventAccumulator(get_task_projection(config).columns)
     instance_list = []
-    df_final = pd.DataFrame()
-    while(1):
-        config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
-        instance_list = extract_baw_data(instance_list, event_list, config, logger)
-
-        if event_list !=  []: # there are events to send
-            df_loop = pd.DataFrame(event_list)
-        if instance_list == []: # Nothing more, exit
-            print("Done, bye!")
-            break;    
-    df_final = pd.concat([df_final, df_loop])
+    # the credentials are resolved once for the run
+    config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
+    # One event loop and one connection pool for all the paging loops of the run
+    with BAWExtractor(config, logger) as extractor:
+        while(1):
+            instance_list = extract_baw_data(instance_list, event_list, config, logger, extractor)
+
+            if not csv_output: # the events of this page are sent to the accumulator
+                started = time.perf_counter()
+                accumulator.add_page(event_list)
+                profile_time(config, "dataframe", started)
+                event_list = []
+            if instance_list == []: # Nothing more, exit
+                print("Done, bye!")
+                break;    
+    if csv_output:
+        filename = event_list.close()
+        close_checkpoint(config, logger)
+        close_profile(config, logger)
+        return filename
+    started = time.perf_counter()
+    df_final = accumulator.dataframe()
+    profile_time(config, "dataframe", started)
+    close_checkpoint(config, logger)
+    close_profile(config, logger)
     return df_final
 
 
 if __name__ == "__main__":
-    df = execute(0)
-    print (df)
\ No newline at end of file
+    # python BAWExtraction_utils.py batch.yaml runs the jobs of the batch file
+    if len(sys.argv) > 1:
+        execute_batch(sys.argv[1])
+    else:
+        df = execute(0)
+        print (df)
\ No newline at end of file
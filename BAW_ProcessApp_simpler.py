@@ -3,6 +3,9 @@ import os
 import requests, urllib3
 requests.packages.urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 #from jsonpath_ng import jsonpath, parse
 import json
 
@@ -105,11 +108,23 @@ def build_instance_search_url(config):
 
     return url
 
-def get_instance_list(instance_list, config):
+# One pooled session for all the requests of the run, the TCP+TLS connections to BAW are kept alive and reused.
+# The pool holds one connection per fetch thread
+def create_session(config):
+    session = requests.Session()
+    # 429, 5xx and connection errors are retried with an exponential backoff
+    retry = Retry(total=config.get('retry_count', 3), backoff_factor=config.get('retry_backoff', 0.5),
+                  status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(config['thread_count'], 1), max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_instance_list(instance_list, config, session):
     try:
         url = build_instance_search_url(config)
         message = f"Search URL : {url}"
-        response = requests.get(url, auth=config['auth_data'], verify=False)
+        response = session.get(url, auth=config['auth_data'], verify=False)
         status = response.status_code
 
         if status == 200:
@@ -127,11 +142,11 @@ def get_instance_list(instance_list, config):
 
     
 
-# Function to fetch task details info for a specific instance
-def create_event(task_id, event_data, config):
+# Function to fetch task details info for a specific task, returns the event or None
+def create_event(task_id, config, session):
     try:
         url = config['root_url'] + TASK_DETAIL_URL + task_id + TASK_DETAIL_URL_SUFFIX
-        task_detail_response = requests.get(url, auth=config['auth_data'], verify=False)
+        task_detail_response = session.get(url, auth=config['auth_data'], verify=False)
         if task_detail_response.status_code == 200:
             task_detail_data = task_detail_response.json()
             task_data = task_detail_data['data']
@@ -177,39 +192,49 @@ def create_event(task_id, event_data, config):
                 # Add the value to the event dictionary (could be "")
             #    event["tsk."+searched_var] = variable_value
 
-            # append event to the event_data array
-            event_data.append(event)
+            return event
     except Exception as e:
         message = f"Unexpected error while creating event for task : {task_id}"
         print(message)
+    return None
 
 
 # Function to fetch task summary info for a specific instance
-def get_tasks(instance_list, config):
-    
-    for instance in instance_list:
-        try:
-            url = config['root_url'] + TASK_SUMMARY_URL + instance['piid'] + TASK_SUMMARY_URL_SUFFIX
-
-            response = requests.get(url, auth=config['auth_data'], verify=False)
-            if response.status_code == 200:
-                task_summary_data = response.json()
-                task_list = []
-                for task_summary in task_summary_data['data']['tasks']:
-                    task_id = task_summary['tkiid']
-                    task_list.append(task_id)
-            instance['task_list'] = task_list
-        
-        except Exception as e:
-            print("--- There was an error in the execution: "+str(e))
-
-
-def extract_baw_data(instance_list, event_data, config): 
+def get_instance_tasks(instance, config, session):
+    task_list = []
+    try:
+        url = config['root_url'] + TASK_SUMMARY_URL + instance['piid'] + TASK_SUMMARY_URL_SUFFIX
+
+        response = session.get(url, auth=config['auth_data'], verify=False)
+        if response.status_code == 200:
+            task_summary_data = response.json()
+            for task_summary in task_summary_data['data']['tasks']:
+                task_id = task_summary['tkiid']
+                task_list.append(task_id)
+
+    except Exception as e:
+        print("--- There was an error in the execution: "+str(e))
+    instance['task_list'] = task_list
+
+# Run fetch(item, config, session) for each item, in a pool of at most config['thread_count'] threads
+# when thread_count > 1. The results are returned in the order of the items
+def fetch_all(fetch, items, config, session):
+    if config['thread_count'] <= 1:
+        return [fetch(item, config, session) for item in items]
+    with ThreadPoolExecutor(max_workers=config['thread_count']) as executor:
+        return list(executor.map(lambda item: fetch(item, config, session), items))
+
+# Function to fetch task summary info for the instances
+def get_tasks(instance_list, config, session):
+    fetch_all(get_instance_tasks, instance_list, config, session)
+
+
+def extract_baw_data(instance_list, event_data, config, session): 
     try:
         # if instance_list size is 0, fetch the processes from BAW
         if len(instance_list) == 0:
             loop_instance_list = []
-            get_instance_list(loop_instance_list, config)
+            get_instance_list(loop_instance_list, config, session)
             if (len(loop_instance_list) == 0):
                 print("No instances match the search")
                 return instance_list
@@ -236,7 +261,7 @@ def extract_baw_data(instance_list, event_data, config):
         instance_count = len(loop_instance_list)
         print(f"Processing {instance_count} instances. Fetching task summaries .....")
 
-        get_tasks(loop_instance_list, config)
+        get_tasks(loop_instance_list, config, session)
 
         # Calculate how many tasks exist in the dictionary
         task_count = 0
@@ -245,9 +270,10 @@ def extract_baw_data(instance_list, event_data, config):
         print(f"Processing {task_count} tasks. Fetching task details .....")
 
         # Create the event row for each task of each instance
-        for instance in loop_instance_list:
-            for task in instance['task_list']:
-                create_event(task, event_data, config)
+        task_list = [task for instance in loop_instance_list for task in instance['task_list']]
+        for event in fetch_all(create_event, task_list, config, session):
+            if event is not None:
+                event_data.append(event)
 
     except Exception as e:
         print("--- There was an error in the execution: "+str(e))
@@ -256,6 +282,25 @@ def extract_baw_data(instance_list, event_data, config):
     return instance_list
 
 
+# Each page of events is converted into a DataFrame chunk once, and the chunks are concatenated once
+# at the end, instead of rebuilding a DataFrame of all the events at every paging loop
+class EventAccumulator:
+
+    def __init__(self):
+        self.chunks = []
+        self.event_count = 0
+
+    def add_page(self, events):
+        if len(events) > 0:
+            self.chunks.append(pd.DataFrame(events))
+            self.event_count += len(events)
+
+    def dataframe(self):
+        if len(self.chunks) == 0:
+            return pd.DataFrame()
+        return pd.concat(self.chunks, ignore_index=True)
+
+
 # This is the entry function for the logic file.
 
 default_config = {
@@ -288,18 +333,21 @@ def execute(context):
     config['BAW_fields'] = baw_fields
 
     event_list = []
+    accumulator = EventAccumulator()
     instance_list = []
-    df_final = pd.DataFrame()
-    while(1):
-        config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
-        instance_list = extract_baw_data(instance_list, event_list, config)
-
-        if event_list !=  []: # there are events to send
-            df_loop = pd.DataFrame(event_list)
-        if instance_list == []: # Nothing more, exit
-            print("Done, bye!")
-            break;    
-    df_final = pd.concat([df_final, df_loop])
+    # The session keeps the connections to BAW open for the whole run
+    with create_session(config) as session:
+        while(1):
+            config['auth_data'] = HTTPBasicAuth(config['user'], config['password'])
+            instance_list = extract_baw_data(instance_list, event_list, config, session)
+
+            # the events of this page are sent to the accumulator
+            accumulator.add_page(event_list)
+            event_list = []
+            if instance_list == []: # Nothing more, exit
+                print("Done, bye!")
+                break;    
+    df_final = accumulator.dataframe()
     return df_final
 
 
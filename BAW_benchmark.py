@@ -0,0 +1,475 @@
+import json
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from contextlib import redirect_stdout, redirect_stderr
+
+from BAW_mock_server import MockBAW, MockServerProcess, add_mock_arguments, mock_settings_from_args, mock_time_window
+
+# End-to-end extraction benchmark against the local mock BAW server.
+# Each target runs in its own process so that peak RSS is measured per target.
+# Wall time per phase is taken from the mock server: it is the time between the
+# first and the last request received on each endpoint.
+#
+#   python BAW_benchmark.py --instances 500 --latency-ms 20 --targets utils_extract processapp
+#
+# --transform-tasks N also runs the event transform microbenchmark on N synthetic task payloads, without any server.
+# --accumulate-pages N also compares the DataFrame accumulation of the execute() paging loop on up to N pages.
+# --event-memory N also measures the memory held per event, dict events vs compact interned rows, on N tasks.
+# --log-stall N also measures the event loop stalls of the DEBUG logging of N tasks, file handler vs queue.
+
+
+TARGETS = ["utils_extract", "utils_execute", "utils_csv", "processapp", "simpler"]
+
+PHASES = {
+    "search": "search",
+    "task_summary": "task summaries",
+    "task_detail": "task details",
+    "task_bulk": "bulk task details"
+}
+
+
+def benchmark_config(root_url, args, workdir):
+    # Overrides applied on top of the default_config of each module
+    from_date, to_date = mock_time_window(mock_settings_from_args(args))
+    return {
+        "root_url": root_url,
+        "from_date": from_date,
+        "from_date_criteria": "createdAfter",
+        "to_date": to_date,
+        "to_date_criteria": "modifiedBefore",
+        "password_env_var": "",
+        "thread_count": args.thread_count,
+        "paging_size": args.paging_size,
+        "loop_rate": 1 if args.paging_size > 0 else 0,
+        "instance_limit": 0,
+        "offset": 0,
+        "status_filter": "",
+        "logfile": os.path.join(workdir, "benchmark.log"),
+        "csvpath": workdir + os.sep,
+        "csvfilename": "benchmark",
+        "dead_letter_file": os.path.join(workdir, "dead_letters.json"),
+        "metrics_file": os.path.join(workdir, "metrics.json"),
+        "metrics_prometheus_file": os.path.join(workdir, "metrics.prom"),
+        "adaptive_concurrency": args.adaptive,
+        "task_detail_mode": args.task_detail_mode,
+        "auth_mode": args.auth_mode
+    }
+
+
+def run_utils_extract(overrides):
+    import BAWExtraction_utils as utils
+    import logging
+    config = dict(utils.default_config)
+    config.update(overrides)
+    config['BAW_fields'] = utils.baw_fields
+    config['auth_data'] = utils.HTTPBasicAuth(config['user'], config['password'])
+    logger = utils.setup_logger(config, logging.INFO)
+    event_list = []
+    instance_list = []
+    while True:
+        instance_list = utils.extract_baw_data(instance_list, event_list, config, logger)
+        if instance_list == []:
+            break
+    return len(event_list)
+
+
+def run_utils_execute(overrides):
+    import BAWExtraction_utils as utils
+    utils.default_config.update(overrides)
+    df = utils.execute(0)
+    return len(df)
+
+
+def run_utils_csv(overrides):
+    import BAWExtraction_utils as utils
+    utils.default_config.update(overrides)
+    utils.default_config['output_format'] = "csv"
+    utils.execute(0)
+    with zipfile.ZipFile(os.path.join(overrides['csvpath'], overrides['csvfilename'] + ".zip")) as zip_file:
+        with zip_file.open(overrides['csvfilename'] + ".csv") as csv_file:
+            return sum(1 for line in csv_file) - 1
+
+
+def run_processapp(overrides):
+    import BAW_BPMN_ProcessApp as processapp
+    config = dict(processapp.default_config)
+    config.update(overrides)
+    # The Process App receives task_data_variables as a comma separated string
+    config['task_data_variables'] = ",".join(config['task_data_variables'])
+    df = processapp.execute({'config': config})
+    return len(df)
+
+
+def run_simpler(overrides):
+    import BAW_ProcessApp_simpler as simpler
+    simpler.default_config.update(overrides)
+    df = simpler.execute(0)
+    return len(df)
+
+
+TARGET_RUNNERS = {
+    "utils_extract": run_utils_extract,
+    "utils_execute": run_utils_execute,
+    "utils_csv": run_utils_csv,
+    "processapp": run_processapp,
+    "simpler": run_simpler
+}
+
+
+def run_target(target, overrides, verbose, results):
+    # Executed in a child process
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        if verbose:
+            event_count = TARGET_RUNNERS[target](overrides)
+        else:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+                event_count = TARGET_RUNNERS[target](overrides)
+        error = None
+    except Exception as e:
+        event_count = 0
+        error = repr(e)
+    results.put({
+        "wall": time.perf_counter() - start,
+        "cpu": time.process_time() - cpu_start,
+        "events": event_count,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "error": error
+    })
+
+
+def benchmark_target(target, server, overrides, verbose):
+    server.reset()
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_target, args=(target, overrides, verbose, results))
+    process.start()
+    result = results.get()
+    process.join()
+    stats = server.stats()
+
+    result['target'] = target
+    result['requests'] = stats['requests']
+    result['connections'] = stats['connections']
+    # Every request that did not open its own connection saved a TCP+TLS handshake
+    result['handshakes_saved'] = stats['requests'] - stats['connections']
+    result['errors'] = sum(s['errors'] for s in stats['endpoints'].values())
+    result['auth_checks'] = stats['auth']['basic']
+    result['bytes_received'] = sum(s['bytes'] for s in stats['endpoints'].values())
+    result['events_per_sec'] = result['events'] / result['wall'] if result['wall'] > 0 else 0
+    result['requests_per_sec'] = result['requests'] / result['wall'] if result['wall'] > 0 else 0
+    result['phases'] = {phase: stats['endpoints'][phase]['span'] for phase in PHASES}
+    return result
+
+
+# Per task projection as done before the compiled TaskProjection, kept as the reference of the transform microbenchmark
+def legacy_projection(task_data, config):
+    from jsonpath_ng import parse
+    task_data_keys = task_data.keys()
+    event = {}
+    ipm_mapping = config['BAW_fields']['process_mining_mapping']
+    for field in ipm_mapping.keys():
+        if (ipm_mapping[field] in task_data_keys):
+            event[field] = task_data.pop(ipm_mapping[field])
+    for key in config['BAW_fields']['included_task_data']:
+        if (key in task_data_keys):
+            event[key] = task_data.pop(key)
+    if (config['export_exposed_variables'] == True) and ("processData" in task_data_keys):
+        for trackeddata in task_data["processData"]['businessData']:
+            event["trkd."+trackeddata['name']] = trackeddata['value']
+    for searched_var in config['task_data_variables']:
+        variable_value = ""
+        for match in parse("variables"+"."+searched_var).find(task_data['data']):
+            variable_value = match.value
+            break
+        event["tsk."+searched_var] = variable_value
+    return event
+
+
+def benchmark_transform(settings, task_count):
+    import logging
+    import BAWExtraction_utils as utils
+    config = dict(utils.default_config)
+    config['BAW_fields'] = utils.baw_fields
+    logger = logging.getLogger("benchmark")
+    mock = MockBAW(dict(settings, instance_count=max(task_count // settings['tasks_min'], 1)))
+    task_count = min(task_count, mock.task_count)
+    payloads = [json.dumps(mock.task_detail(tkiid)) for tkiid in range(1, task_count + 1)]
+
+    def measure(project):
+        # the payloads are decoded outside of the measure, the legacy projection pops the keys it uses
+        task_data_list = [json.loads(payload)['data'] for payload in payloads]
+        start = time.process_time()
+        for task_data in task_data_list:
+            project(task_data)
+        return (time.process_time() - start) / task_count * 1e6
+
+    def measure_decode(decode, raw_payloads, projection):
+        # response body to event: CPU per task, then the allocation peak per task with tracemalloc
+        start = time.process_time()
+        for raw in raw_payloads:
+            projection.project(decode(raw)['data'], logger)
+        cpu = (time.process_time() - start) / task_count * 1e6
+        tracemalloc.start()
+        peaks = 0
+        for raw in raw_payloads:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            projection.project(decode(raw)['data'], logger)
+            peaks += tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        return cpu, peaks / task_count
+
+    projection = utils.TaskProjection(config)
+    results = {
+        "tasks": task_count,
+        "legacy_us_per_task": measure(lambda task_data: legacy_projection(task_data, config)),
+        "compiled_us_per_task": measure(lambda task_data: projection.project(task_data, logger))
+    }
+    # previous decoding: the text of the response through the json module, always with parts=data
+    raw_payloads = [payload.encode('utf-8') for payload in payloads]
+    no_variable_projection = utils.TaskProjection(dict(config, task_data_variables=[]))
+    no_data_payloads = [json.dumps(mock.task_parts(tkiid, "none")).encode('utf-8') for tkiid in range(1, task_count + 1)]
+    decode_cases = {
+        "json": (lambda raw: json.loads(raw.decode('utf-8')), raw_payloads, projection),
+        "fast": (utils.decode_json, raw_payloads, projection),
+        "json_no_variables": (lambda raw: json.loads(raw.decode('utf-8')), raw_payloads, no_variable_projection),
+        "fast_no_variables": (utils.decode_json, no_data_payloads, no_variable_projection)
+    }
+    for name, (decode, raw, case_projection) in decode_cases.items():
+        results[name + "_us_per_task"], results[name + "_bytes_per_task"] = measure_decode(decode, raw, case_projection)
+    return results
+
+
+def print_transform_report(results):
+    print(f"Event transform of {results['tasks']} tasks: legacy projection {results['legacy_us_per_task']:.1f} us/task, "
+          f"compiled projection {results['compiled_us_per_task']:.1f} us/task "
+          f"({results['legacy_us_per_task'] / results['compiled_us_per_task']:.1f}x)")
+    for label, before, after in (("with variables", "json", "fast"), ("without variables", "json_no_variables", "fast_no_variables")):
+        print(f"Decode + transform {label}: json module {results[before + '_us_per_task']:.1f} us/task, "
+              f"{results[before + '_bytes_per_task']:.0f} B allocated/task, fast decode {results[after + '_us_per_task']:.1f} us/task, "
+              f"{results[after + '_bytes_per_task']:.0f} B allocated/task")
+
+
+def benchmark_accumulation(settings, page_count, events_per_page):
+    import logging
+    import pandas as pd
+    import BAWExtraction_utils as utils
+    config = dict(utils.default_config)
+    config['BAW_fields'] = utils.baw_fields
+    mock = MockBAW(dict(settings, instance_count=max(events_per_page // settings['tasks_min'], 1)))
+    projection = utils.TaskProjection(config)
+    page = [projection.project(mock.task_detail(tkiid)['data'], logging.getLogger("benchmark"))
+            for tkiid in range(1, min(events_per_page, mock.task_count) + 1)]
+
+    dict_page = [projection.event_dict(row) for row in page]
+
+    def rebuild(pages):
+        # previous paging loop: a DataFrame of all the events so far at every page
+        event_list = []
+        for i in range(pages):
+            event_list.extend(dict_page)
+            df_loop = pd.DataFrame(event_list)
+        return df_loop
+
+    def accumulate(pages):
+        accumulator = utils.EventAccumulator(projection.columns)
+        for i in range(pages):
+            accumulator.add_page(list(page))
+        return accumulator.dataframe()
+
+    results = []
+    for pages in (page_count // 4, page_count // 2, page_count):
+        result = {"pages": pages, "events": pages * len(page)}
+        for name, accumulate_pages in (("rebuild", rebuild), ("accumulator", accumulate)):
+            start = time.perf_counter()
+            accumulate_pages(pages)
+            result[name] = time.perf_counter() - start
+        results.append(result)
+    return results
+
+
+def benchmark_event_memory(settings, task_count):
+    import logging
+    import BAWExtraction_utils as utils
+    config = dict(utils.default_config)
+    config['BAW_fields'] = utils.baw_fields
+    logger = logging.getLogger("benchmark")
+    mock = MockBAW(dict(settings, instance_count=max(task_count // settings['tasks_min'], 1)))
+    task_count = min(task_count, mock.task_count)
+    payloads = [json.dumps(mock.task_detail(tkiid)) for tkiid in range(1, task_count + 1)]
+
+    def measure(make_event):
+        # memory still held once all the events are created, each payload decoded as it arrives
+        tracemalloc.start()
+        events = [make_event(json.loads(payload)['data']) for payload in payloads]
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return held / len(events)
+
+    # previous representation: one dict per event, no interning
+    dict_projection = utils.TaskProjection(dict(config, max_interned_values=0))
+    row_projection = utils.TaskProjection(config)
+    return {
+        "tasks": task_count,
+        "dict_bytes_per_event": measure(lambda task_data: dict_projection.event_dict(dict_projection.project(task_data, logger))),
+        "row_bytes_per_event": measure(lambda task_data: row_projection.project(task_data, logger))
+    }
+
+
+def benchmark_log_stall(settings, task_count):
+    import logging
+    import BAWExtraction_utils as utils
+    mock = MockBAW(dict(settings, instance_count=max(task_count // settings['tasks_min'], settings['instance_count'], 1)))
+    task_count = min(task_count, mock.task_count)
+    search_response = {"data": {"processes": [
+        {"piid": mock.piid(index), "name": "Benchmark", "lastModificationTime": mock.instance_modification_time(index)}
+        for index in range(settings['instance_count'])]}}
+    instances = [({'piid': mock.piid(mock.task_location(tkiid)[0]), 'lastModificationTime': None, 'task_list': []}, str(tkiid))
+                 for tkiid in range(1, task_count + 1)]
+
+    async def extraction(log_search, log_task):
+        # heartbeat every ms, its lateness is the time the loop was blocked
+        lags = []
+        done = False
+
+        async def heartbeat():
+            while not done:
+                expected = time.perf_counter() + 0.001
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - expected)
+
+        heartbeat_task = asyncio.create_task(heartbeat())
+        await asyncio.sleep(0.002)
+        start = time.perf_counter()
+        log_search(search_response)
+        await asyncio.sleep(0)
+        for instance, task_id in instances:
+            log_task(instance, task_id)
+            await asyncio.sleep(0)
+        wall = time.perf_counter() - start
+        done = True
+        await heartbeat_task
+        lags.sort()
+        return {"wall": wall, "max_lag_ms": lags[-1] * 1000, "p99_lag_ms": lags[int(len(lags) * 0.99)] * 1000}
+
+    results = {"tasks": task_count, "instances": settings['instance_count']}
+    with tempfile.TemporaryDirectory() as workdir:
+        # previous logging: file handler called by the event loop, messages formatted by the caller
+        legacy_logger = logging.getLogger("benchmark.legacy")
+        legacy_logger.propagate = False
+        file_handler = logging.FileHandler(os.path.join(workdir, "legacy.log"))
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'))
+        legacy_logger.addHandler(file_handler)
+        legacy_logger.setLevel(logging.DEBUG)
+        results["file_handler"] = asyncio.run(extraction(
+            lambda response: legacy_logger.debug("Retrieved instance list: %s" % response),
+            lambda instance, task_id: legacy_logger.debug(f"Instance {instance} found Task : {task_id}")))
+        legacy_logger.removeHandler(file_handler)
+        file_handler.close()
+
+        config = dict(utils.default_config, logfile=os.path.join(workdir, "queue.log"))
+        logger = utils.setup_logger(config, logging.DEBUG)
+        results["queue"] = asyncio.run(extraction(
+            lambda response: utils.debug_dump(logger, "Retrieved instance list:", response, config),
+            lambda instance, task_id: logger.debug("Instance %s found Task : %s", instance['piid'], task_id)))
+        start = time.perf_counter()
+        utils.stop_logger(logger)
+        results["queue"]["flush"] = time.perf_counter() - start
+    return results
+
+
+def print_log_stall_report(results):
+    print(f"DEBUG logging of {results['tasks']} tasks, search dump of {results['instances']} instances")
+    print(f"{'logging':<14}{'wall s':>9}{'max lag ms':>12}{'p99 lag ms':>12}")
+    for name in ("file_handler", "queue"):
+        result = results[name]
+        print(f"{name:<14}{result['wall']:>9.2f}{result['max_lag_ms']:>12.1f}{result['p99_lag_ms']:>12.1f}")
+    print(f"queue flushed in {results['queue']['flush']:.2f} s after the extraction")
+
+
+def print_event_memory_report(results):
+    print(f"Event memory of {results['tasks']} tasks: dict events {results['dict_bytes_per_event']:.0f} B/event, "
+          f"compact rows {results['row_bytes_per_event']:.0f} B/event "
+          f"({results['dict_bytes_per_event'] / results['row_bytes_per_event']:.1f}x)")
+
+
+def print_accumulation_report(results):
+    print(f"{'pages':>8}{'events':>10}{'rebuild s':>12}{'accumulator s':>15}")
+    for result in results:
+        print(f"{result['pages']:>8}{result['events']:>10}{result['rebuild']:>12.2f}{result['accumulator']:>15.2f}")
+
+
+def print_report(settings, results):
+    print(f"Mock BAW: {settings['instance_count']} instances, {settings['tasks_min']}-{settings['tasks_max']} tasks/instance, "
+          f"payload {settings['payload_size']} B, latency {settings['latency_ms']}±{settings['latency_jitter_ms']} ms, "
+          f"error rate {settings['error_rate']}")
+    header = f"{'target':<14}{'events':>8}{'wall s':>9}{'cpu s':>8}{'events/s':>10}{'req':>8}{'req/s':>9}{'conns':>7}{'saved':>7}{'errors':>8}{'auth':>7}{'RSS MB':>9}"
+    for phase_name in PHASES.values():
+        header += f"{phase_name + ' s':>20}"
+    print(header)
+    for result in results:
+        line = (f"{result['target']:<14}{result['events']:>8}{result['wall']:>9.2f}{result['cpu']:>8.2f}"
+                f"{result['events_per_sec']:>10.1f}{result['requests']:>8}{result['requests_per_sec']:>9.1f}"
+                f"{result['connections']:>7}{result['handshakes_saved']:>7}{result['errors']:>8}{result['auth_checks']:>7}{result['peak_rss_mb']:>9.1f}")
+        for phase in PHASES:
+            line += f"{result['phases'][phase]:>20.2f}"
+        print(line)
+        if result['error'] is not None:
+            print(f"    {result['target']} failed: {result['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the BAW extraction code against a local mock BAW server")
+    add_mock_arguments(parser)
+    parser.add_argument("--targets", nargs="*", choices=TARGETS, default=TARGETS, help="extraction entry points to benchmark")
+    parser.add_argument("--thread-count", type=int, default=10, help="thread_count used by the extraction")
+    parser.add_argument("--paging-size", type=int, default=0, help="paging_size used by the extraction, 0 = no paging")
+    parser.add_argument("--task-detail-mode", choices=["single", "bulk"], default="single", help="task_detail_mode of the async extraction")
+    parser.add_argument("--auth-mode", choices=["basic", "session"], default="basic", help="auth_mode of the async extraction")
+    parser.add_argument("--adaptive", action="store_true", help="enable the adaptive concurrency of the async extraction")
+    parser.add_argument("--json", dest="json_file", default="", help="also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the extraction code")
+    parser.add_argument("--transform-tasks", type=int, default=0, help="also run the event transform microbenchmark on this many tasks")
+    parser.add_argument("--accumulate-pages", type=int, default=0, help="also run the paging accumulation microbenchmark up to this many pages")
+    parser.add_argument("--event-memory", type=int, default=0, help="also measure the memory per event on this many tasks")
+    parser.add_argument("--log-stall", type=int, default=0, help="also measure the event loop stalls of the DEBUG logging of this many tasks")
+    parser.add_argument("--events-per-page", type=int, default=10, help="events per page of the paging accumulation microbenchmark")
+    args = parser.parse_args(argv)
+
+    settings = mock_settings_from_args(args)
+    results = []
+    if args.transform_tasks > 0:
+        transform_results = benchmark_transform(settings, args.transform_tasks)
+        print_transform_report(transform_results)
+    if args.accumulate_pages > 0:
+        print_accumulation_report(benchmark_accumulation(settings, args.accumulate_pages, args.events_per_page))
+    if args.event_memory > 0:
+        print_event_memory_report(benchmark_event_memory(settings, args.event_memory))
+    if args.log_stall > 0:
+        print_log_stall_report(benchmark_log_stall(settings, args.log_stall))
+    if len(args.targets) == 0:
+        return results
+    with tempfile.TemporaryDirectory() as workdir, MockServerProcess(settings) as server:
+        overrides = benchmark_config(server.root_url, args, workdir)
+        for target in args.targets:
+            results.append(benchmark_target(target, server, overrides, args.verbose))
+
+    print_report(settings, results)
+    if args.json_file != "":
+        with open(args.json_file, 'w') as json_file:
+            json.dump({"settings": settings, "results": results}, json_file, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,481 @@
+import json
+import argparse
+import asyncio
+import bisect
+import random
+import secrets
+import socket
+import time
+import multiprocessing
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+# Local stand-in for the BAW REST endpoints used by the extraction code:
+#   rest/bpm/wle/v1/processes/search
+#   rest/bpm/wle/v1/process/{piid}/taskSummary/
+#   rest/bpm/wle/v1/task/{tkiid}?parts=data (or parts=none, without the variables)
+#   rest/bpm/wle/v1/tasks?taskIDs=...&parts=data
+#   bpm/system/login (POST, returns a csrf_token and sets the LtpaToken2 session cookie)
+# Every request needs Basic auth, which costs auth_cost_ms of user registry check, or the
+# session cookie with its BPMCSRFToken header, which is checked for free.
+# Instances and tasks are synthetic and derived from the seed, so two servers
+# started with the same settings serve exactly the same data.
+# Two admin endpoints are used by the benchmark:
+#   GET  /_mock/stats  request counts, bytes, connections and first/last request time per endpoint
+#   POST /_mock/reset  clear the statistics
+
+
+default_mock_settings = {
+    "instance_count": 100,
+    "tasks_min": 3,
+    "tasks_max": 8,
+    "payload_size": 1024,          # bytes of filler in the data.variables business object
+    "tracked_fields": 3,           # entries in processData.businessData
+    "latency_ms": 0,               # mean injected latency per request
+    "latency_jitter_ms": 0,        # uniform jitter around latency_ms
+    "error_rate": 0.0,             # fraction of task summary/detail requests answered with a 500
+    "search_page_cap": 0,          # server-side cap on processes/search page size, 0 = no cap
+    "auth_cost_ms": 0,             # user registry check of each Basic auth request
+    "session_lifetime_s": 0,       # lifetime of the login sessions, 0 = no expiry
+    "capacity": 0,                 # concurrent requests served at full speed, 0 = unlimited; above it the
+                                   # latency grows with the load and past twice the capacity requests get a 429
+    "seed": 42
+}
+
+SEARCH_PATH = "/rest/bpm/wle/v1/processes/search"
+TASK_SUMMARY_PATH = "/rest/bpm/wle/v1/process/{piid}/taskSummary/"
+TASK_DETAIL_PATH = "/rest/bpm/wle/v1/task/{tkiid}"
+TASK_BULK_PATH = "/rest/bpm/wle/v1/tasks"
+LOGIN_PATH = "/bpm/system/login"
+
+ENDPOINTS = ["search", "task_summary", "task_detail", "task_bulk", "login"]
+
+TEAMS = ["HR Managers", "General Managers", "Recruiters", "Hiring Managers", "Finance"]
+ACTIVITIES = ["Submit position request", "Approve position", "Find job candidates",
+              "Notify hiring manager", "Review candidates", "Schedule interviews",
+              "Approve offer", "Send offer"]
+OWNERS = ["hradmin", "gmuser", "recruiter1", "recruiter2", "hmanager", "finance1", "tw_admin"]
+PRIORITIES = [(10, "Highest"), (20, "High"), (30, "Normal"), (40, "Low")]
+
+BASE_TIME = datetime(2022, 10, 10, 8, 0, 0, tzinfo=timezone.utc)
+
+
+def format_baw_time(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class MockBAW:
+
+    def __init__(self, settings):
+        self.settings = dict(default_mock_settings)
+        self.settings.update(settings)
+        rng = random.Random(self.settings['seed'])
+        # Offsets of the first task of each instance, tkiid = offset + task index + 1
+        self.task_offsets = [0]
+        for i in range(self.settings['instance_count']):
+            self.task_offsets.append(self.task_offsets[-1] + rng.randint(self.settings['tasks_min'], self.settings['tasks_max']))
+        self.filler = "x" * self.settings['payload_size']
+        self.error_rng = random.Random(self.settings['seed'] + 1)
+        self.latency_rng = random.Random(self.settings['seed'] + 2)
+        self.in_flight = 0
+        # LtpaToken2 cookie -> (csrf token, expiry)
+        self.sessions = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {endpoint: {"requests": 0, "errors": 0, "bytes": 0, "first": None, "last": None}
+                      for endpoint in ENDPOINTS}
+        self.connections = set()
+        self.auth = {"basic": 0, "session": 0, "rejected": 0}
+        self.started = time.monotonic()
+
+    def get_stats(self):
+        now = time.monotonic()
+        stats = {"endpoints": {}, "connections": len(self.connections), "elapsed": now - self.started}
+        for endpoint, endpoint_stats in self.stats.items():
+            endpoint_stats = dict(endpoint_stats)
+            if endpoint_stats['first'] is not None:
+                endpoint_stats['span'] = endpoint_stats['last'] - endpoint_stats['first']
+                endpoint_stats['first'] -= self.started
+                endpoint_stats['last'] -= self.started
+            else:
+                endpoint_stats['span'] = 0.0
+            stats['endpoints'][endpoint] = endpoint_stats
+        stats['requests'] = sum(s['requests'] for s in self.stats.values())
+        stats['auth'] = dict(self.auth)
+        return stats
+
+    @property
+    def task_count(self):
+        return self.task_offsets[-1]
+
+    def piid(self, instance_index):
+        return str(1000 + instance_index)
+
+    def instance_index(self, piid):
+        index = int(piid) - 1000
+        if index < 0 or index >= self.settings['instance_count']:
+            raise KeyError(piid)
+        return index
+
+    def instance_tasks(self, instance_index):
+        return range(self.task_offsets[instance_index] + 1, self.task_offsets[instance_index + 1] + 1)
+
+    def instance_creation_time(self, instance_index):
+        return format_baw_time(BASE_TIME + timedelta(hours=instance_index))
+
+    def instance_modification_time(self, instance_index):
+        task_count = len(self.instance_tasks(instance_index))
+        return format_baw_time(BASE_TIME + timedelta(hours=instance_index, minutes=30 * task_count))
+
+    def task_location(self, tkiid):
+        task_number = int(tkiid)
+        if task_number < 1 or task_number > self.task_count:
+            raise KeyError(tkiid)
+        instance_index = bisect.bisect_left(self.task_offsets, task_number) - 1
+        return instance_index, task_number - self.task_offsets[instance_index] - 1
+
+    def task_summary(self, tkiid):
+        instance_index, task_index = self.task_location(tkiid)
+        rng = random.Random(int(tkiid))
+        # every task is closed except, half of the time, the last one of the instance
+        closed = int(tkiid) != self.instance_tasks(instance_index).stop - 1 or rng.random() < 0.5
+        start = BASE_TIME + timedelta(hours=instance_index, minutes=30 * task_index)
+        summary = {
+            "tkiid": str(tkiid),
+            "piid": self.piid(instance_index),
+            "name": ACTIVITIES[task_index % len(ACTIVITIES)],
+            "status": "Closed" if closed else "Received",
+            "state": "STATE_FINISHED" if closed else "STATE_READY",
+            "startTime": format_baw_time(start),
+            "completionTime": format_baw_time(start + timedelta(minutes=rng.randint(1, 29))) if closed else None,
+            "owner": rng.choice(OWNERS),
+            "teamDisplayName": rng.choice(TEAMS),
+            "lastModificationTime": format_baw_time(start + timedelta(minutes=30))
+        }
+        return summary
+
+    def task_detail(self, tkiid):
+        instance_index, task_index = self.task_location(tkiid)
+        rng = random.Random(int(tkiid))
+        summary = self.task_summary(tkiid)
+        start = BASE_TIME + timedelta(hours=instance_index, minutes=30 * task_index)
+        priority, priority_name = rng.choice(PRIORITIES)
+        owner = summary['owner']
+        data = {
+            "activationTime": summary['startTime'],
+            "atRiskTime": format_baw_time(start + timedelta(days=1)),
+            "clientTypes": ["IBM_WLE_COACH"],
+            "completionTime": summary['completionTime'],
+            "containmentContextID": self.piid(instance_index),
+            "description": "",
+            "isAtRisk": rng.random() < 0.1,
+            "kind": "KIND_PARTICIPATING",
+            "externalActivitySnapshotID": None,
+            "serviceID": "1.e9e2bbcf-a5b4-4b4b-a7e8-6a2e8b5d2c7a",
+            "serviceSnapshotID": "2064.6fb0b62b-7b9a-4f08-a8c8-2bc0c8e5c0ab",
+            "serviceType": "Human Service",
+            "flowObjectID": "bpdid:%d" % (task_index % len(ACTIVITIES)),
+            "nextTaskId": None,
+            "actions": ["ACTION_VIEWTASK", "ACTION_COMPLETETASK"],
+            "teamName": summary['teamDisplayName'],
+            "teamID": 24053,
+            "managerTeamName": "Managers",
+            "managerTeamID": 24054,
+            "displayName": "Step: " + summary['name'],
+            "processInstanceName": "Standard HR Open New Position:" + self.piid(instance_index),
+            "assignedTo": owner,
+            "assignedToID": 2048,
+            "collaboration": {"status": ""},
+            "lastModificationTime": summary['lastModificationTime'],
+            "assignedToDisplayName": owner,
+            "closeByUserFullName": owner,
+            "originator": "hradmin",
+            "priority": priority,
+            "startTime": summary['startTime'],
+            "state": summary['state'],
+            "piid": summary['piid'],
+            "priorityName": priority_name,
+            "teamDisplayName": summary['teamDisplayName'],
+            "managerTeamDisplayName": "Managers",
+            "tkiid": summary['tkiid'],
+            "name": summary['name'],
+            "status": summary['status'],
+            "owner": owner,
+            "assignedToType": "user",
+            "dueTime": format_baw_time(start + timedelta(days=2)),
+            "closeByUser": owner,
+            "data": {
+                "variables": {
+                    "requisition": {
+                        "gmApproval": "approved" if rng.random() < 0.7 else "rejected",
+                        "requester": rng.choice(OWNERS),
+                        "notes": self.filler
+                    }
+                }
+            },
+            "processData": {
+                "businessData": [{"name": "tracked%d" % i, "value": rng.randint(0, 1000)}
+                                 for i in range(self.settings['tracked_fields'])]
+            }
+        }
+        return {"status": "200", "data": data}
+
+    # Request handling
+
+    def record(self, request, endpoint, status, body):
+        endpoint_stats = self.stats[endpoint]
+        now = time.monotonic()
+        endpoint_stats['requests'] += 1
+        endpoint_stats['bytes'] += len(body)
+        if status != 200:
+            endpoint_stats['errors'] += 1
+        if endpoint_stats['first'] is None:
+            endpoint_stats['first'] = now
+        endpoint_stats['last'] = now
+        if request.transport is not None:
+            self.connections.add(request.transport.get_extra_info('peername'))
+
+    async def respond(self, request, endpoint, build_payload, inject_errors=True):
+        self.in_flight += 1
+        try:
+            return await self.respond_loaded(request, endpoint, build_payload, inject_errors)
+        finally:
+            self.in_flight -= 1
+
+    async def respond_loaded(self, request, endpoint, build_payload, inject_errors):
+        capacity = self.settings['capacity']
+        load = self.in_flight / capacity if capacity > 0 else 0
+        if self.settings['latency_ms'] > 0 or self.settings['latency_jitter_ms'] > 0:
+            latency = self.settings['latency_ms'] + self.latency_rng.uniform(-1, 1) * self.settings['latency_jitter_ms']
+            if load > 1:
+                latency *= load
+            await asyncio.sleep(max(latency, 0) / 1000)
+        status = 200
+        try:
+            if load > 2:
+                status = 429
+                raise RuntimeError("Too many requests")
+            if inject_errors and self.error_rng.random() < self.settings['error_rate']:
+                raise RuntimeError("Injected failure")
+            payload = build_payload()
+        except KeyError as e:
+            status = 404
+            payload = {"status": "error", "Data": {"errorMessage": "CWTBG0019E: Unknown id %s" % e}}
+        except RuntimeError as e:
+            status = 500 if status == 200 else status
+            payload = {"status": "error", "Data": {"errorMessage": str(e)}}
+        body = json.dumps(payload).encode('utf-8')
+        self.record(request, endpoint, status, body)
+        return web.Response(body=body, status=status, content_type="application/json")
+
+    async def handle_search(self, request):
+        def build_payload():
+            instances = range(self.settings['instance_count'])
+            # the dates have the same format, they compare as strings
+            date_filters = [("createdAfter", self.instance_creation_time, 1), ("createdBefore", self.instance_creation_time, -1),
+                            ("modifiedAfter", self.instance_modification_time, 1), ("modifiedBefore", self.instance_modification_time, -1)]
+            for criteria, instance_time, direction in date_filters:
+                if criteria in request.query:
+                    date = request.query[criteria]
+                    instances = [i for i in instances if (instance_time(i) > date if direction > 0 else instance_time(i) < date)]
+            total = len(instances)
+            offset = int(request.query.get('offset', 0))
+            limit = int(request.query.get('limit', 0)) or total
+            if self.settings['search_page_cap'] > 0:
+                limit = min(limit, self.settings['search_page_cap'])
+            processes = [{"piid": self.piid(i), "name": "Standard HR Open New Position:" + self.piid(i),
+                          "lastModificationTime": self.instance_modification_time(i)}
+                         for i in instances[offset:offset + limit]]
+            return {"status": "200", "data": {"overview": {"Total": total}, "processes": processes}}
+        return await self.respond(request, "search", build_payload, inject_errors=False)
+
+    async def handle_task_summary(self, request):
+        def build_payload():
+            instance_index = self.instance_index(request.match_info['piid'])
+            return {"status": "200", "data": {"tasks": [self.task_summary(tkiid) for tkiid in self.instance_tasks(instance_index)]}}
+        return await self.respond(request, "task_summary", build_payload)
+
+    # parts=none leaves out the data.variables business object and the tracked fields
+    def task_parts(self, tkiid, parts):
+        payload = self.task_detail(tkiid)
+        if parts == "none":
+            payload['data'] = {key: value for key, value in payload['data'].items() if key not in ("data", "processData")}
+        return payload
+
+    async def handle_task_detail(self, request):
+        return await self.respond(request, "task_detail", lambda: self.task_parts(request.match_info['tkiid'], request.query.get('parts', "data")))
+
+    async def handle_task_bulk(self, request):
+        # tasks?taskIDs=1,2,3&parts=data: the details of several tasks, the unknown tkiids are left out
+        def build_payload():
+            tasks = []
+            for tkiid in request.query.get('taskIDs', "").split(","):
+                try:
+                    tasks.append(self.task_parts(tkiid, request.query.get('parts', "data"))['data'])
+                except (KeyError, ValueError):
+                    pass
+            return {"status": "200", "data": {"tasks": tasks}}
+        return await self.respond(request, "task_bulk", build_payload)
+
+    async def handle_login(self, request):
+        token = secrets.token_hex(16)
+        csrf_token = secrets.token_hex(16)
+
+        def build_payload():
+            expiry = time.monotonic() + self.settings['session_lifetime_s'] if self.settings['session_lifetime_s'] > 0 else None
+            self.sessions[token] = (csrf_token, expiry)
+            return {"csrf_token": csrf_token, "expiration": self.settings['session_lifetime_s'] or 7200}
+        response = await self.respond(request, "login", build_payload, inject_errors=False)
+        if response.status == 200:
+            response.set_cookie("LtpaToken2", token)
+        return response
+
+    def valid_session(self, request):
+        session = self.sessions.get(request.cookies.get("LtpaToken2"))
+        if session is None or request.headers.get("BPMCSRFToken") != session[0]:
+            return False
+        return session[1] is None or time.monotonic() < session[1]
+
+    @web.middleware
+    async def authenticate(self, request, handler):
+        if request.path.startswith("/_mock/"):
+            return await handler(request)
+        if request.path != LOGIN_PATH and self.valid_session(request):
+            self.auth['session'] += 1
+            return await handler(request)
+        if request.headers.get("Authorization", "").startswith("Basic "):
+            self.auth['basic'] += 1
+            if self.settings['auth_cost_ms'] > 0:
+                await asyncio.sleep(self.settings['auth_cost_ms'] / 1000)
+            return await handler(request)
+        self.auth['rejected'] += 1
+        return web.json_response({"status": "error", "Data": {"errorMessage": "CWTBG0551E: The user is not authenticated"}}, status=401)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.get_stats())
+
+    async def handle_reset(self, request):
+        self.reset_stats()
+        return web.json_response({"status": "reset"})
+
+    def build_app(self):
+        app = web.Application(middlewares=[self.authenticate])
+        app.router.add_get(SEARCH_PATH, self.handle_search)
+        app.router.add_get(TASK_SUMMARY_PATH, self.handle_task_summary)
+        app.router.add_get(TASK_DETAIL_PATH, self.handle_task_detail)
+        app.router.add_get(TASK_BULK_PATH, self.handle_task_bulk)
+        app.router.add_post(LOGIN_PATH, self.handle_login)
+        app.router.add_get("/_mock/stats", self.handle_stats)
+        app.router.add_post("/_mock/reset", self.handle_reset)
+        return app
+
+
+# from_date and to_date covering all the synthetic instances of the settings
+def mock_time_window(settings):
+    instance_count = settings.get('instance_count', default_mock_settings['instance_count'])
+    return format_baw_time(BASE_TIME - timedelta(days=1)), format_baw_time(BASE_TIME + timedelta(hours=instance_count, days=30))
+
+
+def run_mock_server(settings, host="127.0.0.1", port=8080):
+    mock = MockBAW(settings)
+    web.run_app(mock.build_app(), host=host, port=port, print=None, access_log=None)
+
+
+def find_free_port(host="127.0.0.1"):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class MockServerProcess:
+    # Runs the mock server in its own process so that its CPU and memory
+    # do not pollute the measurements taken on the extraction side.
+
+    def __init__(self, settings, host="127.0.0.1", port=0):
+        self.settings = settings
+        self.host = host
+        self.port = port or find_free_port(host)
+        self.root_url = f"http://{host}:{self.port}/"
+        self.process = None
+
+    def start(self, timeout=10):
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=run_mock_server, args=(self.settings, self.host, self.port), daemon=True)
+        self.process.start()
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.stats()
+                return self
+            except OSError:
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    self.stop()
+                    raise RuntimeError("Mock BAW server did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def stats(self):
+        with urllib.request.urlopen(self.root_url + "_mock/stats") as response:
+            return json.loads(response.read())
+
+    def reset(self):
+        request = urllib.request.Request(self.root_url + "_mock/reset", data=b"", method="POST")
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--instances", type=int, default=default_mock_settings['instance_count'], help="number of synthetic process instances")
+    parser.add_argument("--tasks-min", type=int, default=default_mock_settings['tasks_min'], help="minimum number of tasks per instance")
+    parser.add_argument("--tasks-max", type=int, default=default_mock_settings['tasks_max'], help="maximum number of tasks per instance")
+    parser.add_argument("--payload-size", type=int, default=default_mock_settings['payload_size'], help="bytes of filler in each task data.variables")
+    parser.add_argument("--latency-ms", type=float, default=default_mock_settings['latency_ms'], help="mean injected latency per request")
+    parser.add_argument("--latency-jitter-ms", type=float, default=default_mock_settings['latency_jitter_ms'], help="uniform jitter around the latency")
+    parser.add_argument("--error-rate", type=float, default=default_mock_settings['error_rate'], help="fraction of task requests answered with a 500")
+    parser.add_argument("--search-page-cap", type=int, default=default_mock_settings['search_page_cap'], help="server-side cap on the search page size")
+    parser.add_argument("--auth-cost-ms", type=float, default=default_mock_settings['auth_cost_ms'], help="user registry check of each Basic auth request")
+    parser.add_argument("--session-lifetime-s", type=float, default=default_mock_settings['session_lifetime_s'], help="lifetime of the login sessions, 0 = no expiry")
+    parser.add_argument("--capacity", type=int, default=default_mock_settings['capacity'], help="concurrent requests served at full speed, 0 = unlimited")
+    parser.add_argument("--seed", type=int, default=default_mock_settings['seed'])
+
+
+def mock_settings_from_args(args):
+    return {
+        "instance_count": args.instances,
+        "tasks_min": args.tasks_min,
+        "tasks_max": args.tasks_max,
+        "payload_size": args.payload_size,
+        "latency_ms": args.latency_ms,
+        "latency_jitter_ms": args.latency_jitter_ms,
+        "error_rate": args.error_rate,
+        "search_page_cap": args.search_page_cap,
+        "auth_cost_ms": args.auth_cost_ms,
+        "session_lifetime_s": args.session_lifetime_s,
+        "capacity": args.capacity,
+        "seed": args.seed
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock BAW REST server with synthetic instances and tasks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    settings = mock_settings_from_args(args)
+    print(f"Mock BAW serving {settings['instance_count']} instances on http://{args.host}:{args.port}/")
+    run_mock_server(settings, args.host, args.port)
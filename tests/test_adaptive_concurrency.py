@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+
+logger = logging.getLogger("test_adaptive_concurrency")
+
+
+def adaptive_scheduler(limit=8, initial_limit=2, window=4):
+    return utils.RequestScheduler(limit, logger, adaptive=True, initial_limit=initial_limit, window=window)
+
+# one window of completed requests with the same latency and status
+def record_window(scheduler, latency, status=200):
+    for _ in range(scheduler.window):
+        request = utils.ScheduledRequest()
+        request.status = status
+        scheduler._record(request, latency)
+
+
+def test_adaptive_limit_grows_while_latency_is_flat():
+    scheduler = adaptive_scheduler()
+    assert scheduler.current_limit == 2
+    record_window(scheduler, 0.01)
+    record_window(scheduler, 0.01)
+    assert int(scheduler.current_limit) == 4
+    # capped by the configured limit
+    for _ in range(10):
+        record_window(scheduler, 0.01)
+    assert scheduler.current_limit == scheduler.limit
+
+def test_adaptive_limit_backs_off_when_latency_rises():
+    scheduler = adaptive_scheduler(initial_limit=8)
+    record_window(scheduler, 0.01)
+    record_window(scheduler, 0.05)
+    assert scheduler.current_limit == pytest.approx(7.2)
+
+def test_adaptive_limit_halves_on_failures():
+    scheduler = adaptive_scheduler(initial_limit=8)
+    record_window(scheduler, 0.01, status=503)
+    assert scheduler.current_limit == 4
+    record_window(scheduler, 0.01, status=429)
+    record_window(scheduler, 0.01, status=500)
+    record_window(scheduler, 0.01, status=500)
+    # never below one request
+    assert scheduler.current_limit == 1
+
+def test_adaptive_limit_bounds_the_requests_in_flight():
+    async def request(scheduler):
+        async with scheduler.slot() as request:
+            await asyncio.sleep(0.005)
+            request.status = 200
+
+    async def run():
+        scheduler = adaptive_scheduler(initial_limit=3, window=1000)
+        await asyncio.gather(*[request(scheduler) for _ in range(30)])
+        return scheduler
+    usage = asyncio.run(run()).pool_usage()
+    assert usage['peak_in_flight'] == 3
+    assert usage['requests'] == 30
+    assert usage['current_limit'] == 3
@@ -0,0 +1,59 @@
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+
+logger = logging.getLogger("test_circuit_breaker")
+
+
+def test_breaker_opens_after_threshold():
+    breaker = utils.CircuitBreaker(3, 60, logger)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    assert breaker.trips == 1
+    assert 0 < breaker.remaining() <= 60
+
+def test_success_resets_the_failure_count():
+    breaker = utils.CircuitBreaker(2, 60, logger)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow_request()
+
+def test_breaker_disabled_with_zero_threshold():
+    breaker = utils.CircuitBreaker(0, 60, logger)
+    for _ in range(100):
+        breaker.record_failure()
+    assert breaker.allow_request()
+    assert breaker.trips == 0
+
+def test_breaker_lets_one_probe_through_when_half_open():
+    breaker = utils.CircuitBreaker(1, 0.01, logger)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow_request()
+    # the other requests wait for the verdict of the probe
+    assert not breaker.allow_request()
+    breaker.record_success()
+    assert breaker.allow_request()
+    assert breaker.opened is None
+
+def test_failed_probe_opens_the_circuit_again():
+    breaker = utils.CircuitBreaker(1, 0.01, logger)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    assert not breaker.probing
+    # still the same outage
+    assert breaker.trips == 1
+    time.sleep(0.02)
+    assert breaker.allow_request()
@@ -0,0 +1,51 @@
+import csv
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+
+
+def sink_config(tmp_path, **overrides):
+    config = dict(utils.default_config, BAW_fields=utils.baw_fields, csvpath=str(tmp_path), csvfilename="events")
+    config.update(overrides)
+    return config
+
+def read_zip_csv(filename):
+    with zipfile.ZipFile(filename) as zip_file:
+        with zip_file.open("events.csv") as csv_file:
+            return list(csv.reader(io.TextIOWrapper(csv_file, encoding='utf-8', newline='')))
+
+
+def test_events_are_written_under_the_columns(tmp_path):
+    sink = utils.CSVEventSink(sink_config(tmp_path))
+    row = tuple(f"value{index}" if index < 2 else None for index in range(len(sink.columns)))
+    sink.append(row + (None,))
+    filename = sink.close()
+    assert filename == os.path.join(str(tmp_path), "events.zip")
+    header, written = read_zip_csv(filename)
+    assert header == sink.columns
+    assert written[:3] == ["value0", "value1", ""]
+
+def test_no_events_leave_the_previous_output(tmp_path):
+    previous = tmp_path / "events.zip"
+    previous.write_bytes(b"previous run")
+    sink = utils.CSVEventSink(sink_config(tmp_path))
+    assert sink.close() is None
+    assert previous.read_bytes() == b"previous run"
+
+def test_no_events_create_no_file(tmp_path):
+    sink = utils.CSVEventSink(sink_config(tmp_path, csv_compression="none"))
+    assert sink.close() is None
+    assert os.listdir(str(tmp_path)) == []
+
+def test_exported_tracked_fields_need_exposed_variables(tmp_path):
+    with pytest.raises(ValueError):
+        utils.CSVEventSink(sink_config(tmp_path, export_exposed_variables=True, exposed_variables=[]))
+    sink = utils.CSVEventSink(sink_config(tmp_path, export_exposed_variables=True, exposed_variables=["amount"]))
+    assert "trkd.amount" in sink.columns
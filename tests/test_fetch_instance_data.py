@@ -0,0 +1,66 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+
+logger = logging.getLogger("test_fetch_instance_data")
+
+
+class FakeResponse:
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        self.headers = {}
+
+    async def read(self):
+        return self.body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+# The search answers one instance per page, its last page is malformed; the task summaries never answer
+class BrokenSearchSession:
+
+    def __init__(self, total):
+        self.total = total
+
+    def get(self, url, **kwargs):
+        if "processes/search" not in url:
+            return HangingResponse()
+        if "offset=" not in url:
+            page = {"data": {"processes": [{"piid": "1"}], "overview": {"Total": self.total}}}
+            return FakeResponse(200, json.dumps(page).encode())
+        if f"offset={self.total - 1}" in url:
+            return FakeResponse(200, b"{not json")
+        return HangingResponse()
+
+class HangingResponse:
+
+    async def __aenter__(self):
+        await asyncio.Event().wait()
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+def test_failed_search_stops_the_pipeline():
+    config = dict(utils.default_config, BAW_fields=utils.baw_fields, retry_count=0, thread_count=4,
+                  search_page_size=1, dead_letter_file="")
+
+    async def run():
+        with pytest.raises(ValueError):
+            await utils.fetch_instance_data(BrokenSearchSession(4), [], [], config, logger, search=True)
+        # no worker nor search page is left pending in the loop
+        return asyncio.all_tasks() - {asyncio.current_task()}
+    assert asyncio.run(run()) == set()
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+from BAW_mock_server import MockServerProcess, default_mock_settings
+
+logger = logging.getLogger("test_session_login")
+
+
+# Minimal stand-ins of the aiohttp response and session, answering from a list of (status, body)
+class FakeResponse:
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        self.headers = {}
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return self.body.decode()
+
+    async def json(self):
+        return json.loads(self.body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+class FakeSession:
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.logins = 0
+
+    def get(self, url, **kwargs):
+        return FakeResponse(*self.responses.pop(0))
+
+    def post(self, url, **kwargs):
+        self.logins += 1
+        return FakeResponse(200, json.dumps({"csrf_token": f"token-{self.logins}"}).encode())
+
+# A server that never answers
+class HangingSession:
+
+    def get(self, url, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        await asyncio.Event().wait()
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+def request_config(**overrides):
+    config = dict(utils.default_config, retry_count=0, retry_backoff=0,
+                  circuit_breaker_threshold=1, circuit_breaker_reset_timeout=0.01)
+    config.update(overrides)
+    return config
+
+# a scheduler whose circuit is half-open: the next request is the probe
+async def half_open_scheduler(config):
+    scheduler = utils.create_request_scheduler(config, logger)
+    scheduler.breaker.record_failure()
+    assert not scheduler.breaker.allow_request()
+    await asyncio.sleep(config['circuit_breaker_reset_timeout'] * 2)
+    return scheduler
+
+
+def test_login_once_then_send_the_csrf_token():
+    async def run():
+        config = request_config(auth_mode="session")
+        scheduler = utils.create_request_scheduler(config, logger)
+        session = FakeSession([(200, b'{"data": 1}'), (200, b'{"data": 2}')])
+        results = [await utils.get_baw_json(session, scheduler, "url", config, logger, "task_detail") for _ in range(2)]
+        return scheduler, session, results
+    scheduler, session, results = asyncio.run(run())
+    assert results == [(200, {"data": 1}), (200, {"data": 2})]
+    assert session.logins == 1
+    assert scheduler.session_login.headers() == {"BPMCSRFToken": "token-1"}
+
+def test_probe_with_malformed_body_does_not_lock_the_breaker():
+    async def run():
+        config = request_config()
+        scheduler = await half_open_scheduler(config)
+        with pytest.raises(ValueError):
+            await utils.get_baw_json(FakeSession([(200, b"{not json")]), scheduler, "url", config, logger, "task_detail")
+        return scheduler
+    scheduler = asyncio.run(run())
+    assert not scheduler.breaker.probing
+    assert scheduler.breaker.allow_request()
+
+def test_cancelled_probe_does_not_lock_the_breaker():
+    async def run():
+        config = request_config()
+        scheduler = await half_open_scheduler(config)
+        probe = asyncio.ensure_future(utils.get_baw_json(HangingSession(), scheduler, "url", config, logger, "task_detail"))
+        await asyncio.sleep(0.01)
+        assert scheduler.breaker.probing
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return scheduler
+    scheduler = asyncio.run(run())
+    assert scheduler.breaker.allow_request()
+    assert scheduler.in_flight == 0
+
+def test_relogin_during_probe_closes_the_breaker():
+    async def run():
+        config = request_config(auth_mode="session", retry_count=1)
+        scheduler = await half_open_scheduler(config)
+        session = FakeSession([(401, b"expired"), (200, b'{"data": {}}')])
+        result = await utils.get_baw_json(session, scheduler, "url", config, logger, "task_detail")
+        return scheduler, session, result
+    scheduler, session, result = asyncio.run(run())
+    assert result == (200, {"data": {}})
+    assert session.logins == 2
+    assert scheduler.breaker.opened is None
+    assert scheduler.breaker.allow_request()
+
+
+@pytest.fixture(scope="module")
+def mock_server():
+    settings = dict(default_mock_settings, instance_count=1, tasks_min=1, tasks_max=1, session_lifetime_s=0.2)
+    with MockServerProcess(settings) as server:
+        yield server
+
+def test_expired_login_session_during_probe_against_mock_server(mock_server):
+    async def run():
+        config = request_config(root_url=mock_server.root_url, auth_mode="session", retry_count=1,
+                                circuit_breaker_reset_timeout=0.3)
+        url = config['root_url'] + utils.TASK_DETAIL_URL + "1" + utils.TASK_DETAIL_URL_SUFFIX
+        async with utils.create_session(config, logger) as session:
+            scheduler = utils.create_request_scheduler(config, logger)
+            await scheduler.session_login.ensure(session)
+            scheduler.breaker.record_failure()
+            # the login session expires while the circuit is open
+            await asyncio.sleep(0.35)
+            status, payload = await utils.get_baw_json(session, scheduler, url, config, logger, "task_detail")
+            return scheduler, status
+    scheduler, status = asyncio.run(run())
+    assert status != 401
+    assert scheduler.session_login.logins == 2
+    assert scheduler.breaker.opened is None
+    assert scheduler.breaker.allow_request()
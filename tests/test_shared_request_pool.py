@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+
+logger = logging.getLogger("test_shared_request_pool")
+
+
+# start a request on the pool and let it reach its wait
+async def waiting_acquire(pool, job):
+    task = asyncio.ensure_future(pool.acquire(job))
+    await asyncio.sleep(0)
+    assert not task.done()
+    return task
+
+
+def test_pool_hands_freed_slots_round_robin():
+    async def run():
+        pool = utils.SharedRequestPool(1)
+        await pool.acquire("big")
+        order = []
+        for job in ["big", "big", "big", "small"]:
+            task = await waiting_acquire(pool, job)
+            task.add_done_callback(lambda _, job=job: order.append(job))
+        for _ in range(4):
+            pool.release()
+            await asyncio.sleep(0)
+        pool.release()
+        return pool, order
+    pool, order = asyncio.run(run())
+    # the small job does not wait behind all the requests of the big one
+    assert order == ["big", "small", "big", "big"]
+    assert pool.in_flight == 0
+
+def test_pool_skips_cancelled_waiters():
+    async def run():
+        pool = utils.SharedRequestPool(1)
+        await pool.acquire("a")
+        cancelled = await waiting_acquire(pool, "a")
+        waiting = await waiting_acquire(pool, "b")
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        pool.release()
+        await asyncio.sleep(0)
+        assert waiting.done() and not waiting.cancelled()
+        pool.release()
+        return pool
+    pool = asyncio.run(run())
+    assert pool.in_flight == 0
+
+def test_pool_hands_over_again_a_slot_given_to_a_cancelled_waiter():
+    async def run():
+        pool = utils.SharedRequestPool(1)
+        await pool.acquire("a")
+        cancelled = await waiting_acquire(pool, "a")
+        waiting = await waiting_acquire(pool, "b")
+        # the slot goes to the first waiter, which is cancelled before it runs again
+        pool.release()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await asyncio.sleep(0)
+        assert waiting.done() and not waiting.cancelled()
+        pool.release()
+        return pool
+    pool = asyncio.run(run())
+    assert pool.in_flight == 0
+
+def test_scheduler_cancelled_while_waiting_for_the_pool_frees_its_slot():
+    async def run():
+        pool = utils.SharedRequestPool(1)
+        # the waiting job has a single slot of its own: if the cancelled request kept it, the next one would hang
+        busy, waiting = utils.RequestScheduler(1, logger), utils.RequestScheduler(1, logger)
+        busy.pool = waiting.pool = pool
+        async with busy.slot():
+            task = asyncio.ensure_future(waiting.slot().__aenter__())
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        async def next_request():
+            async with waiting.slot() as request:
+                request.status = 200
+        await asyncio.wait_for(next_request(), 1)
+        return pool, waiting
+    pool, waiting = asyncio.run(run())
+    assert waiting.pool_usage()['requests'] == 1
+    assert pool.in_flight == 0
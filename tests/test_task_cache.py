@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BAWExtraction_utils as utils
+
+
+def cache_config():
+    return dict(utils.default_config, BAW_fields=utils.baw_fields)
+
+def stored_rows(filename):
+    connection = sqlite3.connect(filename)
+    try:
+        return dict(connection.execute("SELECT tkiid, last_used FROM task_cache").fetchall())
+    finally:
+        connection.close()
+
+
+def test_writes_wait_for_the_flush(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    cache = utils.TaskCache(filename, 100, cache_config())
+    cache.put("1", {"name": "closed"}, True)
+    cache.put("2", {"name": "open"}, False)
+    # not written yet, but already served
+    assert stored_rows(filename) == {}
+    assert cache.get("1") == {"name": "closed"}
+    assert cache.get("2") is None
+    cache.flush()
+    assert set(stored_rows(filename)) == {"1", "2"}
+    cache.close()
+
+def test_hits_touch_last_used_at_the_flush(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    cache = utils.TaskCache(filename, 100, cache_config())
+    cache.put("1", {"name": "closed"}, True)
+    cache.flush()
+    written = stored_rows(filename)["1"]
+    assert cache.get("1") == {"name": "closed"}
+    assert stored_rows(filename)["1"] == written
+    cache.flush()
+    assert stored_rows(filename)["1"] > written
+    assert cache.hits == 1
+    cache.close()
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    cache = utils.TaskCache(filename, 2, cache_config())
+    cache.put("1", {"name": "first"}, True)
+    cache.put("2", {"name": "second"}, True)
+    cache.flush()
+    cache.get("1")
+    cache.put("3", {"name": "third"}, True)
+    cache.close()
+    assert set(stored_rows(filename)) == {"1", "3"}
+    assert cache.evictions == 1
+
+def test_two_caches_share_one_file(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    first, second = utils.TaskCache(filename, 100, cache_config()), utils.TaskCache(filename, 100, cache_config())
+    first.put("1", {"name": "first"}, True)
+    second.put("2", {"name": "second"}, True)
+    first.flush()
+    second.flush()
+    assert second.get("1") == {"name": "first"}
+    first.close()
+    second.close()